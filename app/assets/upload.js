@@ -0,0 +1,75 @@
+// Posts the selected pdf to the /upload endpoint as the raw request body, the server
+// streams it to disk, so the file never passes through a Dash callback as base64.
+
+// the file picked in the dialog or dropped on the drop zone, waiting to be posted
+let selectedFile = null;
+
+function inDropZone(event) {
+    return event.target.closest && event.target.closest("#upload-drop-zone");
+}
+
+// selecting or dropping a file starts the upload
+function selectFile(file) {
+    if (!file) {
+        return;
+    }
+    selectedFile = file;
+    document.getElementById("upload-button").click();
+}
+
+// Dash has no file input component, a click on the drop zone opens the file dialog
+document.addEventListener("click", function (event) {
+    if (inDropZone(event)) {
+        const input = document.createElement("input");
+        input.type = "file";
+        input.accept = ".pdf,application/pdf";
+        input.addEventListener("change", function () {
+            selectFile(input.files[0]);
+        });
+        input.click();
+    }
+});
+
+document.addEventListener("dragover", function (event) {
+    if (inDropZone(event)) {
+        // allows the drop
+        event.preventDefault();
+    }
+});
+
+document.addEventListener("drop", function (event) {
+    if (inDropZone(event)) {
+        event.preventDefault();
+        selectFile(event.dataTransfer.files[0]);
+    }
+});
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    uploads: {
+        upload_file: function (n_clicks, jobId) {
+            const file = selectedFile;
+            if (!file) {
+                return window.dash_clientside.no_update;
+            }
+            selectedFile = null;
+
+            const params = new URLSearchParams({filename: file.name});
+            if (jobId) {
+                params.set("job_id", jobId);
+            }
+            return fetch("/upload?" + params.toString(), {
+                method: "POST",
+                headers: {"Content-Type": "application/pdf"},
+                body: file,
+            })
+                .then(function (response) {
+                    return response.json().catch(function () {
+                        return {error: "Upload failed (" + response.status + ")."};
+                    });
+                })
+                .catch(function () {
+                    return {error: "Upload failed, please try again."};
+                });
+        },
+    },
+});
@@ -0,0 +1,177 @@
+"""
+Headless batch assessment of referral PDFs.
+
+Assesses every PDF in the given files/directories with the same decision logic as the
+dashboard and appends one JSON record per document to the output file as soon as the
+document is finished. The models are loaded once for the whole batch. Documents that
+already have a successful record in the output file are skipped, so an interrupted
+batch can simply be restarted with the same command.
+
+Usage:
+    python app/batch.py app/data/ --output results.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from functions import metrics, model_registry
+from functions.extraction import read_pdf_text
+from functions.guidelines import load_guidelines
+from functions.history import recorded
+from functions.hashing import hash_files
+from functions.medical_assessment import run_assessment
+from functions.progress import ProgressStore
+from functions.response_cache import get_response_cache
+from functions.scheduler import default_max_workers
+
+logger = logging.getLogger("batch")
+
+
+def find_documents(paths):
+    """Expand files and directories into a sorted list of pdf paths."""
+    documents = []
+    for path in paths:
+        if os.path.isdir(path):
+            documents.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.lower().endswith(".pdf")
+            )
+        elif path.lower().endswith(".pdf"):
+            documents.append(path)
+        else:
+            logger.warning("Skipping %s, not a pdf or directory", path)
+    return documents
+
+
+def load_finished(output_path):
+    """Content hashes of the documents that already have a successful record in the output."""
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a record that was half-written when the previous run crashed
+                continue
+            if "error" not in record:
+                finished.add(record["document_hash"])
+    return finished
+
+
+def assess_document(path, max_workers, confidence_bound, fresh, confidence_mode,
+                    mode="per_criterion", document_hash=None):
+    """Run the assessment for a single document and return its JSON record."""
+    progress = ProgressStore()
+    start = time.time()
+    document_hash = document_hash or hash_files([path])
+    with metrics.recording(progress, criterion="index"):
+        query_engine = model_registry.build_query_engine(
+            input_files=[path], refresh_responses=fresh, content_hash=document_hash
+        )
+        with metrics.timed("document_load"):
+            document_text = read_pdf_text([path])
+    # also kept in the assessment history, next to the dashboard's assessments
+    with recorded(progress, {path: document_hash}, mode=mode, confidence_mode=confidence_mode) as run:
+        results = run["results"] = run_assessment(
+            query_engine,
+            progress,
+            confidence_bound=confidence_bound,
+            max_workers=max_workers,
+            model_contexts=model_registry.MODEL_CONTEXTS,
+            document_text=document_text,
+            scorer=model_registry.get_scorer() if confidence_mode == "logprob" else None,
+            mode=mode,
+        )
+    return {
+        "mode": mode,
+        "confidence_mode": confidence_mode,
+        "results": results,
+        "rows": progress.get_results()[1],
+        "letter": progress.get_status()[1].strip(),
+        "timings": progress.get_timings()[1],
+        "seconds": round(time.time() - start, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("paths", nargs="+", help="pdf files or directories containing pdfs")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file to append to")
+    parser.add_argument(
+        "--confidence-bound", type=float, default=None,
+        help="stop sampling a criterion once the winning answer is this sure (0-1)",
+    )
+    parser.add_argument(
+        "--max-workers", type=int, default=None,
+        help="criteria assessed in parallel, defaults to one per model context",
+    )
+    parser.add_argument(
+        "--confidence-mode", choices=["vote", "logprob"], default="vote",
+        help="majority vote over repeated samples, or yes/no token probability of one pass",
+    )
+    parser.add_argument(
+        "--mode", choices=["per_criterion", "one_shot"], default="per_criterion",
+        help="ask every criterion separately, or all of them in one JSON answer",
+    )
+    parser.add_argument(
+        "--fresh", action="store_true",
+        help="sample the model again instead of reusing cached answers",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    max_workers = args.max_workers or default_max_workers(model_registry.MODEL_CONTEXTS)
+
+    documents = find_documents(args.paths)
+    finished = load_finished(args.output)
+
+    start = time.time()
+    # a broken guideline fails here rather than on the first document that needs it
+    load_guidelines()
+    model_registry.warm_up()
+    n_assessed = n_failed = 0
+
+    with open(args.output, "a") as output:
+        for i, path in enumerate(documents):
+            document_hash = hash_files([path])
+            if document_hash in finished:
+                logger.info("[%d/%d] %s already assessed, skipping", i + 1, len(documents), path)
+                continue
+
+            logger.info("[%d/%d] assessing %s", i + 1, len(documents), path)
+            record = {"document": path, "document_hash": document_hash}
+            try:
+                record.update(assess_document(
+                    path, max_workers, args.confidence_bound, args.fresh,
+                    args.confidence_mode, args.mode, document_hash=document_hash,
+                ))
+                n_assessed += 1
+            except Exception as e:
+                logger.exception("Assessment of %s failed", path)
+                record["error"] = str(e)
+                n_failed += 1
+
+            # one record per line, flushed so results stream out while the batch runs
+            output.write(json.dumps(record, default=str) + "\n")
+            output.flush()
+            finished.add(document_hash)
+
+    elapsed = time.time() - start
+    docs_per_hour = (n_assessed + n_failed) / elapsed * 3600 if elapsed > 0 else 0.0
+    logger.info(
+        "Assessed %d documents (%d failed, %d skipped) in %.0fs, %.1f docs/hour",
+        n_assessed, n_failed, len(documents) - n_assessed - n_failed, elapsed, docs_per_hour,
+    )
+    logger.info("Response cache: %s", get_response_cache().stats())
+    logger.info("Prompt prefix cache: %s", model_registry.prefix_cache_stats())
+    logger.info("Embedding cache: %s", model_registry.embedding_cache_stats())
+
+
+if __name__ == "__main__":
+    main()
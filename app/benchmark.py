@@ -0,0 +1,263 @@
+"""
+Offline benchmark of the assessment pipeline.
+
+Runs run_assessment end to end on synthetic referral PDFs, with a deterministic stub
+LLM and a stub embedding model instead of Mistral and gte-large, so it needs no model
+downloads and finishes in seconds. The stubs sleep like the real models would (see
+the --*-latency options), the rest of the pipeline (pdf parsing, chunking, indexing,
+retrieval, scheduling, sampling and parsing) is the real code.
+
+For every scenario and mode it reports the wall time, the time per stage, the LLM
+calls per criterion, the number of embedded texts and the peak memory, as JSON, so
+results can be compared across changes. The import times of the web layer and of the
+ML stack, each in a fresh interpreter, are reported as well.
+
+Usage:
+    python app/benchmark.py --output benchmark.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from llama_index import ServiceContext
+
+from functions import metrics, startup
+from functions.benchmark_backends import StubEmbedding, StubLLM, referral_lines, write_pdf
+from functions.extraction import read_pdf_text
+from functions.index_cache import load_or_build_index
+from functions.medical_assessment import run_assessment
+from functions.model_registry import CHUNK_SIZE
+from functions.progress import ProgressStore
+
+logger = logging.getLogger("benchmark")
+
+HISTORY = [
+    "58 year old patient referred for evaluation of intermittent rectal bleeding and",
+    "abdominal pain over the last three months. Iron deficiency anemia on recent labs.",
+    "Mother was diagnosed with colorectal cancer at age 61.",
+    "No prior colonoscopy on record. No history of polyposis syndromes.",
+    "Trial of fiber supplementation and dietary changes did not improve the symptoms.",
+]
+
+# name -> CPT code in the letter and the probability of a "Yes" per criterion
+SCENARIOS = {
+    # a different procedure is requested, the assessment stops after the CPT code
+    "non_colonoscopy": {"cpt_code": 43235, "answers": {}},
+    # an earlier treatment helped, the assessment stops after previous_success
+    "prior_success": {"cpt_code": 45378, "answers": {"previous_success": 0.9}},
+    # every criterion is assessed
+    "full_criteria": {
+        "cpt_code": 45378,
+        "answers": {
+            "previous_success": 0.1,
+            "colonoscopy": 0.2,
+            "relatives": 0.7,
+            "symptomatic": 0.8,
+            "juvenile_polyposis": 0.05,
+        },
+    },
+}
+
+
+def stage_seconds(events):
+    """Seconds between the start and the end of every stage in the progress events."""
+    started = {}
+    seconds = {}
+    for event in events:
+        if event["type"] == "stage_started":
+            started[event["stage"]] = event["time"]
+        elif event["type"] == "stage_finished" and event["stage"] in started:
+            seconds[event["stage"]] = round(event["time"] - started.pop(event["stage"]), 4)
+    return seconds
+
+
+def phase_seconds(timings):
+    """Seconds per phase (retrieval, llm, parsing, ...) summed over the criteria."""
+    seconds = {}
+    for row in timings:
+        seconds[row["phase"]] = round(seconds.get(row["phase"], 0.0) + row["seconds"], 4)
+    return seconds
+
+
+def run_scenario(name, scenario, mode, args, work_dir):
+    """Assess the scenario's synthetic letter once and return the measurements."""
+    pdf_path = os.path.join(work_dir, f"{name}.pdf")
+    write_pdf(pdf_path, referral_lines(scenario["cpt_code"], "03/14/1958", HISTORY,
+                                       filler_pages=args.filler_pages))
+
+    llm = StubLLM(
+        answers=scenario["answers"],
+        cpt_code=scenario["cpt_code"],
+        prompt_seconds_per_token=args.prompt_latency,
+        seconds_per_token=args.token_latency,
+        seed=args.seed,
+    )
+    embed_model = StubEmbedding(seconds_per_text=args.embed_latency)
+    service_context = ServiceContext.from_defaults(
+        chunk_size=CHUNK_SIZE, llm=llm, embed_model=embed_model,
+        callback_manager=metrics.callback_manager(),
+    )
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    progress = ProgressStore()
+    with metrics.recording(progress, criterion="index"):
+        # a fresh index cache per run, so indexing is always measured
+        index = load_or_build_index(
+            [pdf_path], service_context, CHUNK_SIZE, "stub",
+            cache_dir=tempfile.mkdtemp(dir=work_dir),
+        )
+    index_seconds = time.perf_counter() - start
+
+    results = run_assessment(
+        index.as_query_engine(),
+        progress,
+        confidence_bound=args.confidence_bound,
+        max_workers=args.max_workers,
+        model_contexts=args.model_contexts,
+        document_text=read_pdf_text([pdf_path]),
+        mode=mode,
+    )
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds": round(seconds, 4),
+        "index_seconds": round(index_seconds, 4),
+        "stage_seconds": stage_seconds(progress.events),
+        "phase_seconds": phase_seconds(progress.get_timings()[1]),
+        "llm_calls": sum(llm.calls.values()),
+        "llm_calls_per_criterion": llm.calls,
+        "texts_embedded": embed_model.texts_embedded,
+        "peak_python_mb": round(peak / 1024**2, 2),
+        "recommendation": results["recommendation"],
+    }
+
+
+def summarize(runs):
+    """Median timings over the repeats, counts and memory of the run with the highest peak."""
+    summary = dict(max(runs, key=lambda run: run["peak_python_mb"]))
+    summary["seconds"] = round(statistics.median(run["seconds"] for run in runs), 4)
+    summary["index_seconds"] = round(statistics.median(run["index_seconds"] for run in runs), 4)
+    summary["stage_seconds"] = {
+        stage: round(statistics.median(run["stage_seconds"].get(stage, 0.0) for run in runs), 4)
+        for stage in sorted({stage for run in runs for stage in run["stage_seconds"]})
+    }
+    summary["phase_seconds"] = {
+        phase: round(statistics.median(run["phase_seconds"].get(phase, 0.0) for run in runs), 4)
+        for phase in sorted({phase for run in runs for phase in run["phase_seconds"]})
+    }
+    summary["repeats"] = len(runs)
+    return summary
+
+
+def import_seconds(modules):
+    """Seconds to import 'modules' one after the other in a fresh interpreter, None if it fails."""
+    code = (
+        "import json\n"
+        "from functions.startup import timed_import\n"
+        f"print(json.dumps({{name: round(timed_import(name), 4) for name in {list(modules)!r}}}))"
+    )
+    try:
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout
+        # the last line, modules may log to stdout while they are imported
+        return json.loads(output.strip().splitlines()[-1])
+    except (OSError, subprocess.CalledProcessError, ValueError, IndexError) as e:
+        logger.warning("Could not time the import of %s: %s", modules, e)
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("-o", "--output", default=None, help="write the JSON report here instead of stdout")
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=sorted(SCENARIOS), default=sorted(SCENARIOS),
+    )
+    parser.add_argument(
+        "--modes", nargs="+", choices=["per_criterion", "one_shot"], default=["per_criterion", "one_shot"],
+    )
+    parser.add_argument("--repeats", type=int, default=3, help="runs per scenario and mode")
+    parser.add_argument("--max-workers", type=int, default=1, help="criteria assessed in parallel")
+    parser.add_argument(
+        "--model-contexts", type=int, default=1,
+        help="generations the model runs side by side, more than one lets criteria be asked speculatively",
+    )
+    parser.add_argument("--confidence-bound", type=float, default=None)
+    parser.add_argument(
+        "--prompt-latency", type=float, default=0.0,
+        help="seconds the stub LLM spends per prompt word",
+    )
+    parser.add_argument(
+        "--token-latency", type=float, default=0.0,
+        help="seconds the stub LLM spends per generated word",
+    )
+    parser.add_argument(
+        "--embed-latency", type=float, default=0.0, help="seconds the stub embedder spends per chunk",
+    )
+    parser.add_argument("--filler-pages", type=int, default=1, help="boilerplate pages per letter")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the stub answers")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "settings": {
+            key: value for key, value in vars(args).items() if key not in ("output",)
+        },
+        "results": [],
+    }
+    # the dashboard serves after the web layer is imported, it is ready after the ML stack
+    report["import_seconds"] = {
+        "web": import_seconds(["main"]),
+        "ml_stack": import_seconds(startup.HEAVY_MODULES),
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in args.scenarios:
+            for mode in args.modes:
+                runs = [
+                    run_scenario(name, SCENARIOS[name], mode, args, work_dir)
+                    for _ in range(args.repeats)
+                ]
+                result = {"scenario": name, "mode": mode, **summarize(runs)}
+                report["results"].append(result)
+                logger.warning(
+                    "%s/%s: %.3fs, %d LLM calls", name, mode, result["seconds"], result["llm_calls"]
+                )
+    # kilobytes on Linux
+    report["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.llms import CompletionResponse, CustomLLM, LLMMetadata
+from llama_index.llms.base import llm_completion_callback
+
+from functions.output_schemas import current_schema
+from functions.cancellation import current_token
+
+# keywords in a question -> criterion, checked in this order
+CRITERION_KEYWORDS = [
+    ("all_criteria", "json object"),
+    ("code", "cpt code"),
+    ("age", "date of birth"),
+    ("previous_success", "previous treatment"),
+    ("colonoscopy", "colonoscopy"),
+    ("relatives", "family history"),
+    ("symptomatic", "symptomatic"),
+    ("juvenile_polyposis", "juvenile polyposis"),
+]
+
+# keys of the JSON object asked for in the one-shot prompt
+ONE_SHOT_KEY = re.compile(r'^- "(\w+)":', re.MULTILINE)
+
+
+def _question(prompt):
+    # the question follows the retrieved context in the QA prompt
+    _, _, question = prompt.rpartition("Query:")
+    return (question or prompt).lower()
+
+
+def criterion_of(prompt):
+    """The criterion a prompt asks about, None if it can't be told."""
+    question = _question(prompt)
+    for criterion, keyword in CRITERION_KEYWORDS:
+        if keyword in question:
+            return criterion
+    return None
+
+
+class StubLLM(CustomLLM):
+    """
+    Deterministic stand-in for the llama.cpp model.
+
+    It recognises which criterion a prompt asks about, answers it in the shape of the
+    active output schema and sleeps like a CPU model would: a cost per prompt token
+    (words stand in for tokens) and per generated token. Generations are serialized
+    like on the real model, and every call is counted per criterion.
+
+    Yes/no answers are drawn with 'answers[criterion]' as the probability of a yes,
+    seeded by the question and the number of times it was asked, so repeated runs
+    give the same answers regardless of thread timing.
+
+    Like the real model it raises Cancelled before and after a call once the current
+    cancel token is set.
+    """
+
+    answers: dict = Field(default_factory=dict)
+    cpt_code: int = 45378
+    date_of_birth: str = "03/14/1958"
+    prompt_seconds_per_token: float = 0.0
+    seconds_per_token: float = 0.0
+    seed: int = 0
+
+    _calls: Counter = PrivateAttr(default_factory=Counter)
+    _asked: Counter = PrivateAttr(default_factory=Counter)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls):
+        return "StubLLM"
+
+    @property
+    def metadata(self):
+        return LLMMetadata(context_window=3900, num_output=256, model_name="stub")
+
+    @property
+    def calls(self):
+        return dict(self._calls)
+
+    def _yes(self, criterion, question):
+        self._asked[question] += 1
+        digest = hashlib.sha256(f"{self.seed}:{question}:{self._asked[question]}".encode("utf-8"))
+        return random.Random(digest.digest()).random() < self.answers.get(criterion, 0.0)
+
+    def _answer(self, criterion, question):
+        schema = current_schema()
+        if criterion == "code":
+            return str(self.cpt_code) if schema else f"The CPT code is {self.cpt_code}."
+        if criterion == "age":
+            return self.date_of_birth
+        if criterion == "all_criteria":
+            return json.dumps({
+                name: "Yes" if self._yes(name, f"{question}:{name}") else "No"
+                for name in ONE_SHOT_KEY.findall(question)
+            })
+        yes = self._yes(criterion, question)
+        if criterion == "relatives":
+            return "mother" if yes else "None"
+        return "Yes" if yes else "No"
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        criterion = criterion_of(prompt)
+        token = current_token()
+        with self._lock:
+            if token is not None:
+                token.check()
+            self._calls[criterion or "other"] += 1
+            text = self._answer(criterion, _question(prompt))
+            time.sleep(
+                len(prompt.split()) * self.prompt_seconds_per_token
+                + len(text.split()) * self.seconds_per_token
+            )
+        if token is not None:
+            token.check()
+        return CompletionResponse(text=text)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        response = self.complete(prompt, formatted=formatted, **kwargs)
+        yield CompletionResponse(text=response.text, delta=response.text)
+
+
+class StubEmbedding(BaseEmbedding):
+    """
+    Hashing bag-of-words embedding, so retrieval still favours chunks that share
+    words with the question. Costs 'seconds_per_text' per embedded text.
+    """
+
+    dim: int = 256
+    seconds_per_text: float = 0.0
+
+    _texts: int = PrivateAttr(default=0)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls):
+        return "StubEmbedding"
+
+    @property
+    def texts_embedded(self):
+        return self._texts
+
+    def _vector(self, text):
+        vector = [0.0] * self.dim
+        for word in re.findall(r"\w+", text.lower()):
+            bucket = int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % self.dim
+            vector[bucket] += 1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def _get_text_embeddings(self, texts):
+        with self._lock:
+            self._texts += len(texts)
+        time.sleep(len(texts) * self.seconds_per_text)
+        return [self._vector(text) for text in texts]
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_query_embedding(self, query):
+        return self._get_text_embedding(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, lines, lines_per_page=50):
+    """
+    Write 'lines' as a plain text pdf (Helvetica 10pt), without any pdf library.
+
+    Parameters:
+    path (str): Where the pdf is written.
+    lines (list of str): Text lines, latin-1 only.
+    lines_per_page (int, optional): Lines before a new page is started.
+    """
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+    n_pages = len(pages)
+
+    # objects: 1 catalog, 2 page tree, 3 font, then a page and its content stream per page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        (
+            "<< /Type /Pages /Kids ["
+            + " ".join(f"{4 + 2 * i} 0 R" for i in range(n_pages))
+            + f"] /Count {n_pages} >>"
+        ).encode("latin-1"),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, page in enumerate(pages):
+        text = "BT /F1 10 Tf 14 TL 50 780 Td " + " ".join(
+            f"({_pdf_escape(line)}) '" for line in page
+        ) + " ET"
+        stream = text.encode("latin-1")
+        objects.append(
+            (
+                "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>"
+            ).encode("latin-1")
+        )
+        objects.append(
+            b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream"
+        )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    ).encode()
+    with open(path, "wb") as f:
+        f.write(bytes(out))
+
+
+BOILERPLATE = [
+    "CONFIDENTIAL FAX COVER SHEET",
+    "This facsimile contains protected health information. If you received it in error,",
+    "please notify the sender immediately and destroy all copies.",
+    "",
+    "CONSENT FOR RELEASE OF MEDICAL INFORMATION",
+    "I authorize the release of my medical records to the provider named above for the",
+    "purpose of continuity of care. This authorization expires one year from signing.",
+]
+
+
+def referral_lines(cpt_code, date_of_birth, history, filler_pages=1):
+    """
+    Text of a synthetic referral letter like app/data/medical-record-3.pdf.
+
+    Parameters:
+    cpt_code (int): Requested procedure, written next to a "CPT code" label.
+    date_of_birth (str): mm/dd/yyyy, written next to a "Date of Birth" label.
+    history (list of str): Clinical history lines.
+    filler_pages (int, optional): Pages of fax cover and consent boilerplate.
+    """
+    lines = [
+        "Riverside Family Practice - Referral for Gastroenterology",
+        "",
+        "Patient: Jane Example    Date of Birth: " + date_of_birth,
+        f"Requested procedure: CPT code {cpt_code}",
+        "",
+        "Clinical history:",
+    ]
+    lines += history
+    lines += ["", "Kind regards,", "Dr. A. Referrer", ""]
+    for _ in range(filler_pages):
+        lines += BOILERPLATE * 7
+    return lines
@@ -0,0 +1,54 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+
+# cancel token of the assessment running in the current thread, if any
+_current_token = contextvars.ContextVar("cancel_token", default=None)
+
+
+class Cancelled(Exception):
+    """The assessment was cancelled, by the user or by a newer run of the same job."""
+
+
+class CancelToken:
+    """
+    Cooperative cancellation of an assessment.
+
+    The token is checked between LLM calls and, through llama.cpp's stopping criteria,
+    after every generated token (see SerializedLlamaCPP). A token also counts as set
+    once any of its 'parents' is, so a criterion can be stopped either on its own or
+    together with the whole assessment.
+
+    Parameters:
+    parents (CancelToken or threading.Event): Tokens this token follows.
+    """
+
+    def __init__(self, *parents):
+        self._event = threading.Event()
+        self._parents = parents
+
+    def cancel(self):
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set() or any(parent.is_set() for parent in self._parents)
+
+    def check(self):
+        """Raise Cancelled if the token is set."""
+        if self.is_set():
+            raise Cancelled()
+
+
+@contextmanager
+def cancellable(token):
+    """LLM calls inside this block stop once 'token' is set."""
+    reset = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
+
+
+def current_token():
+    """The token set by cancellable in this thread, or None."""
+    return _current_token.get()
@@ -0,0 +1,218 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+
+logger = logging.getLogger(__name__)
+
+# One sub-directory per embedding model with the vectors and their index.
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "./cache/embeddings")
+
+# Chunks embedded in one call, a typical referral fits in a single batch.
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 64))
+
+
+class EmbeddingStore:
+    """
+    Append-only store of embeddings keyed by the hash of the embedded text.
+
+    The vectors are kept as float16 rows of one memory-mapped file, a sqlite table
+    maps every text hash to its row. Vectors are only ever appended, so a row never
+    moves once it has been written.
+
+    Parameters:
+    directory (str): Where 'vectors.f16' and 'index.sqlite' are kept.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, "vectors.f16")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors = None
+
+        # waits for the other processes' appends instead of failing at once
+        self._db = sqlite3.connect(
+            os.path.join(directory, "index.sqlite"), timeout=30, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, row INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        self._db.commit()
+        self.dim = None
+        self.size = 0
+        self._refresh()
+        logger.info("Embedding cache %s: %d vectors", directory, self.size)
+
+    def _refresh(self):
+        # other processes (batch runs, more web workers) append to the same files
+        if self.dim is None:
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+            self.dim = row[0] if row else None
+        # rows in the vectors file
+        self.size = os.path.getsize(self.vectors_path) // (self.dim * 2) if self.dim else 0
+
+    def _map(self, rows_needed):
+        # (re)open the memory map once rows were appended after it was opened,
+        # by this process or another one
+        if rows_needed > self.size:
+            self._refresh()
+        if self._vectors is None or len(self._vectors) < rows_needed:
+            self._vectors = np.memmap(
+                self.vectors_path, dtype=np.float16, mode="r", shape=(self.size, self.dim)
+            )
+        return self._vectors
+
+    def get_many(self, keys):
+        """Return the cached vector (float32) of every key, None for the ones not cached."""
+        with self._lock:
+            rows = {}
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows.update(self._db.execute(
+                    f"SELECT key, row FROM rows WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall())
+            vectors = self._map(max(rows.values()) + 1) if rows else None
+            found = [
+                vectors[rows[key]].astype(np.float32) if key in rows else None for key in keys
+            ]
+            n_found = sum(vector is not None for vector in found)
+            self.hits += n_found
+            self.misses += len(keys) - n_found
+            return found
+
+    def put_many(self, keys, vectors):
+        """
+        Append new vectors, stored as float16.
+
+        Returns:
+        list of np.ndarray: The vectors as they will be read back from the store.
+        """
+        vectors = np.asarray(vectors, dtype=np.float16)
+        with self._lock:
+            # the write transaction also serializes the appends of other processes
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh()
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                    self._db.execute("INSERT INTO meta (name, value) VALUES ('dim', ?)", (self.dim,))
+                # a key that was stored since the lookup missed it is written only once
+                stored = {
+                    key for (key,) in self._db.execute(
+                        f"SELECT key FROM rows WHERE key IN ({','.join('?' * len(keys))})", keys
+                    )
+                }
+                new = [i for i, key in enumerate(keys) if key not in stored]
+                if new:
+                    # the vectors go to disk before their rows are committed, a crash in
+                    # between leaves unreferenced bytes at worst
+                    with open(self.vectors_path, "ab") as f:
+                        start = -(-f.tell() // (self.dim * 2))
+                        f.write(b"\0" * (start * self.dim * 2 - f.tell()))
+                        f.write(vectors[new].tobytes())
+                    self._db.executemany(
+                        "INSERT INTO rows (key, row) VALUES (?, ?)",
+                        [(keys[i], start + n) for n, i in enumerate(new)],
+                    )
+                    self.size = start + len(new)
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+        return list(vectors.astype(np.float32))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.size,
+            "bytes": self.size * (self.dim or 0) * 2,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def text_key(kind, text):
+    """Cache key of a text, queries and chunks may be embedded differently."""
+    return hashlib.sha256(f"{kind}\0{text}".encode("utf-8")).hexdigest()
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Embedding model that never embeds the same text twice.
+
+    Chunks that repeat across uploads (letterheads, consent forms, fax covers, earlier
+    letters of the same patient) and the criteria questions are looked up by their
+    text hash, only the misses of a batch are sent to the wrapped model, in one call.
+
+    Parameters:
+    embed_model (BaseEmbedding): The model that computes the embeddings.
+    model_name (str): Name of the embedding model, selects the cache directory.
+    cache_dir (str, optional): Parent directory of the per-model caches.
+    symmetric (bool, optional): The model embeds questions like chunks (no query
+                                instruction, e.g. gte-large), so several questions
+                                can be embedded in one batch.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _store: EmbeddingStore = PrivateAttr()
+    _symmetric: bool = PrivateAttr()
+
+    def __init__(self, embed_model, model_name, cache_dir=EMBEDDING_CACHE_DIR, symmetric=False):
+        self._embed_model = embed_model
+        self._symmetric = symmetric
+        self._store = EmbeddingStore(os.path.join(cache_dir, re.sub(r"[^\w.-]", "_", model_name)))
+        super().__init__(model_name=model_name, embed_batch_size=EMBED_BATCH_SIZE)
+
+    @classmethod
+    def class_name(cls):
+        return "CachedEmbedding"
+
+    def _embed(self, kind, texts, compute):
+        keys = [text_key(kind, text) for text in texts]
+        vectors = self._store.get_many(keys)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # the same text can appear twice in one batch, it is embedded once
+            unique = list(dict.fromkeys(keys[i] for i in missing))
+            first = {keys[i]: i for i in reversed(missing)}
+            computed = self._store.put_many(unique, compute([texts[first[key]] for key in unique]))
+            new = dict(zip(unique, computed))
+            for i in missing:
+                vectors[i] = new[keys[i]]
+        return [vector.tolist() for vector in vectors]
+
+    def _get_query_embedding(self, query):
+        return self._embed("query", [query], self._embed_queries)[0]
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _embed_queries(self, queries):
+        if self._symmetric:
+            return self._embed_model.get_text_embedding_batch(queries)
+        return [self._embed_model.get_query_embedding(query) for query in queries]
+
+    def get_query_embedding_batch(self, queries):
+        """Embed several questions, the ones that aren't cached in one call if the model is symmetric."""
+        return self._embed("query", queries, self._embed_queries)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._embed("text", texts, self._embed_model.get_text_embedding_batch)
+
+    def stats(self):
+        return self._store.stats()
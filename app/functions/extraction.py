@@ -0,0 +1,126 @@
+import re
+from datetime import datetime
+
+from pypdf import PdfReader
+
+
+def read_pdf_text(file_paths):
+    """
+    Extract the text of every page of the given pdf files.
+
+    Parameters:
+    file_paths (list of str): The pdf files.
+
+    Returns:
+    str: The text of all pages, separated by newlines.
+    """
+    pages = []
+    for file_path in file_paths:
+        if not file_path.lower().endswith(".pdf"):
+            continue
+        for page in PdfReader(file_path).pages:
+            pages.append(page.extract_text() or "")
+    return "\n".join(pages)
+
+
+# a CPT code is only taken from a line that requests the procedure, after this label
+REQUEST_CONTEXT = re.compile(
+    r"\b(?:requested\s+(?:procedure|treatment)s?|procedures?\s+requested|ordered|referral\s+for)\b",
+    re.IGNORECASE,
+)
+# lines with a date or about the patient's history describe past procedures
+HISTORY_CONTEXT = re.compile(
+    r"\d{1,2}[/\-.]\d{1,2}[/\-.]\d{2,4}|\b(?:19|20)\d{2}\b|\b(?:previous|prior|past|history)\b",
+    re.IGNORECASE,
+)
+CPT_CODE = re.compile(r"(?<![\d\-/.])\b(\d{5})\b(?![\d\-/])")
+
+
+def extract_cpt_code(text):
+    """
+    Find the CPT code of the requested procedure in the document text without asking the LLM.
+
+    Only 5-digit numbers that follow a request label on the same line (e.g. "Requested
+    procedure: CPT code 45378", "Referral for colonoscopy (45378)") are considered, so
+    the codes of past procedures, zip codes, phone numbers and record numbers are
+    ignored. Lines with a date or about the patient's history are skipped entirely.
+
+    Parameters:
+    text (str): The text of the medical record.
+
+    Returns:
+    int or None: The CPT code, or None if no code or several different codes were found.
+    """
+    codes = set()
+    for line in text.splitlines():
+        request = REQUEST_CONTEXT.search(line)
+        if request is None or HISTORY_CONTEXT.search(line):
+            continue
+        codes.update(int(code) for code in CPT_CODE.findall(line, request.end()))
+
+    # ambiguous or missing, let the LLM decide
+    if len(codes) != 1:
+        return None
+    return codes.pop()
+
+
+DOB_LABEL = re.compile(
+    r"(?:\bDOB\b|\bD\.O\.B\.?|\bdate\s+of\s+birth\b|\bbirth\s*date\b|\bborn(?:\s+on)?\b)\s*[:\-]?\s*",
+    re.IGNORECASE,
+)
+
+MONTHS = r"(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)[a-z]*\.?"
+
+# (pattern, strptime formats) for the date formats we see in referral letters
+DATE_PATTERNS = [
+    (re.compile(r"\d{1,2}/\d{1,2}/\d{4}"), ["%m/%d/%Y"]),
+    (re.compile(r"\d{1,2}-\d{1,2}-\d{4}"), ["%m-%d-%Y"]),
+    (re.compile(r"\d{1,2}\.\d{1,2}\.\d{4}"), ["%d.%m.%Y"]),
+    (re.compile(r"\d{4}-\d{1,2}-\d{1,2}"), ["%Y-%m-%d"]),
+    (re.compile(MONTHS + r"\s+\d{1,2},?\s+\d{4}", re.IGNORECASE), ["%B %d %Y", "%b %d %Y"]),
+    (re.compile(r"\d{1,2}\s+" + MONTHS + r",?\s+\d{4}", re.IGNORECASE), ["%d %B %Y", "%d %b %Y"]),
+]
+
+
+def parse_date(date_string, formats):
+    """Parse 'date_string' with the first of 'formats' that fits, None if none do."""
+    cleaned = date_string.replace(",", " ").replace(".", " ").replace("Sept", "Sep")
+    cleaned = " ".join(cleaned.split())
+    for date_format in formats:
+        for candidate in (date_string, cleaned):
+            try:
+                return datetime.strptime(candidate, date_format)
+            except ValueError:
+                continue
+    return None
+
+
+def extract_date_of_birth(text):
+    """
+    Find the patient's date of birth in the document text without asking the LLM.
+
+    A date is only taken if it directly follows a date of birth label (DOB, D.O.B.,
+    Date of Birth, Birth date, Born). Supported formats are mm/dd/yyyy, mm-dd-yyyy,
+    dd.mm.yyyy, yyyy-mm-dd, "January 2, 1960" and "2 January 1960".
+
+    Parameters:
+    text (str): The text of the medical record.
+
+    Returns:
+    datetime or None: The date of birth, or None if none or several different dates were found.
+    """
+    dates = set()
+    for label in DOB_LABEL.finditer(text):
+        following = text[label.end():label.end() + 30]
+        for pattern, formats in DATE_PATTERNS:
+            match = pattern.match(following)
+            if match:
+                date = parse_date(match.group(), formats)
+                if date is not None and date <= datetime.today():
+                    dates.add(date)
+                break
+
+    # ambiguous or missing, let the LLM decide
+    if len(dates) != 1:
+        return None
+    return dates.pop()
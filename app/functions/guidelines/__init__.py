@@ -0,0 +1,177 @@
+import importlib
+import pkgutil
+import string
+import threading
+
+from functions.llm_output_functions import evaluate_success
+from functions.one_shot import JointQuestion
+from functions.output_schemas import YES_NO
+from functions.sampling import majority_vote
+
+# criteria the engine answers for every guideline, from the document text or the LLM
+BUILTIN_CRITERIA = {"age"}
+# fields every letter can use besides the criteria
+LETTER_FIELDS = {"code", "age"}
+
+
+class Criterion:
+    """
+    A question of a guideline, asked about the patient's documents.
+
+    Parameters:
+    name (str): Key of the answer, used by the decision rules and the letters.
+    question (str): The question that is sampled in the per-criterion mode.
+    description (str): Row label in the results table.
+    status (str): Status shown on the dashboard while the criterion is asked.
+    yes_no_question (str, optional): A question answered with just yes or no, for the
+                                     token probability mode. Defaults to 'question'.
+    one_shot_question (str, optional): The question in the joint prompt of the
+                                       one-shot mode. Defaults to 'yes_no_question'.
+    schema (OutputSchema, optional): Shape of the sampled answers. Defaults to YES_NO.
+    yes_share (float, optional): Share of "Yes" samples needed to answer "Yes", e.g.
+                                 0.25 for findings that are easily missed. Defaults
+                                 to a strict majority.
+    cost (float, optional): Cost of a sample relative to a yes/no answer, e.g. for
+                            longer answers. Cheaper criteria are asked first.
+    """
+
+    def __init__(self, name, question, description, status, yes_no_question=None,
+                 one_shot_question=None, schema=YES_NO, yes_share=None, cost=1):
+        self.name = name
+        self.question = question
+        self.description = description
+        self.status = status
+        self.yes_no_question = yes_no_question or question
+        self.one_shot_question = one_shot_question or self.yes_no_question
+        self.schema = schema
+        self.yes_share = yes_share
+        self.cost = cost
+
+    def decide(self, yes_count, no_count):
+        """Decision rule of the vote, see AdaptiveVote."""
+        if self.yes_share is None:
+            return majority_vote(yes_count, no_count)
+        if yes_count == 0 and no_count == 0:
+            return None
+        return yes_count / (yes_count + no_count) >= self.yes_share
+
+    def summarize(self, vote):
+        """The answer ("Yes"/"No") and the confidence shown in the results table."""
+        if self.yes_share is None:
+            return evaluate_success(vote.yes_count, vote.no_count)
+        decided = self.decide(vote.yes_count, vote.no_count)
+        if decided is None:
+            return None, "Unsure."
+        # the share the vote was decided on, abstaining and unparsable samples don't count
+        share = vote.yes_count / max(1, vote.yes_count + vote.no_count)
+        if decided:
+            return "Yes", f"{share * 100} % sure"
+        return "No", f"{(1 - share) * 100} % sure"
+
+
+class Guideline:
+    """
+    When a procedure is advised, as data: the criteria, the decision over their
+    answers and the letter for every verdict.
+
+    Guidelines are defined in the modules of this package (as a module level
+    GUIDELINE) and picked up by load_guidelines, the engine doesn't need to change.
+
+    Parameters:
+    cpt_code (int): The procedure the guideline is for.
+    name (str): Name of the procedure.
+    criteria (list of Criterion): The questions, in the order of the results table.
+    decision (Decision): Verdict over the answers of the criteria and BUILTIN_CRITERIA.
+    letters (dict): verdict -> letter template, str.format fields are the criteria
+                    and LETTER_FIELDS. Unanswered criteria read "Skipped".
+    """
+
+    def __init__(self, cpt_code, name, criteria, decision, letters):
+        self.cpt_code = cpt_code
+        self.name = name
+        self.criteria = criteria
+        self.decision = decision
+        self.letters = letters
+
+
+class GuidelinePlan:
+    """
+    A validated guideline, with everything an assessment needs prepared up front:
+    the criteria by name, the verdicts and the joint question of the one-shot mode.
+    """
+
+    def __init__(self, guideline):
+        self.cpt_code = guideline.cpt_code
+        self.name = guideline.name
+        self.criteria = {criterion.name: criterion for criterion in guideline.criteria}
+        self.decision = guideline.decision
+        self.letters = guideline.letters
+        self.joint = JointQuestion(
+            f"all_criteria_{guideline.cpt_code}",
+            [(criterion.name, criterion.one_shot_question) for criterion in guideline.criteria],
+        )
+        self.decide = {criterion.name: criterion.decide for criterion in guideline.criteria}
+
+
+def validate(guideline):
+    """Raise a ValueError if 'guideline' can't be run, e.g. a rule refers to an unknown criterion."""
+    where = f"Guideline {guideline.name!r} (CPT {guideline.cpt_code})"
+    if not isinstance(guideline.cpt_code, int) or not 10000 <= guideline.cpt_code <= 99999:
+        raise ValueError(f"{where}: a CPT code has 5 digits.")
+
+    names = [criterion.name for criterion in guideline.criteria]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{where}: criterion names must be unique.")
+    clashes = set(names) & (BUILTIN_CRITERIA | LETTER_FIELDS)
+    if clashes:
+        raise ValueError(f"{where}: {sorted(clashes)} are reserved criterion names.")
+
+    unknown = guideline.decision.criteria() - set(names) - BUILTIN_CRITERIA
+    if unknown:
+        raise ValueError(f"{where}: the decision refers to unknown criteria {sorted(unknown)}.")
+
+    verdicts = {verdict for _, verdict in guideline.decision.branches}
+    verdicts.add(guideline.decision.default)
+    missing = verdicts - set(guideline.letters)
+    if missing:
+        raise ValueError(f"{where}: no letter for the verdicts {sorted(missing)}.")
+
+    for verdict, letter in guideline.letters.items():
+        fields = {field for _, field, _, _ in string.Formatter().parse(letter) if field is not None}
+        unknown = fields - set(names) - LETTER_FIELDS
+        if unknown:
+            raise ValueError(f"{where}: the {verdict!r} letter uses unknown fields {sorted(unknown)}.")
+
+
+_plans = None
+_lock = threading.Lock()
+
+
+def load_guidelines():
+    """
+    Import, validate and plan every guideline in this package, once per process.
+
+    Returns:
+    dict: CPT code -> GuidelinePlan.
+    """
+    global _plans
+    with _lock:
+        if _plans is None:
+            plans = {}
+            for module_info in pkgutil.iter_modules(__path__):
+                module = importlib.import_module(f"{__name__}.{module_info.name}")
+                guideline = getattr(module, "GUIDELINE", None)
+                if guideline is None:
+                    continue
+                validate(guideline)
+                if guideline.cpt_code in plans:
+                    raise ValueError(f"Two guidelines for CPT code {guideline.cpt_code}.")
+                plans[guideline.cpt_code] = GuidelinePlan(guideline)
+            _plans = plans
+    return _plans
+
+
+def plan_for(code):
+    """The plan of the guideline for CPT 'code', None if there is none."""
+    plans = _plans if _plans is not None else load_guidelines()
+    return plans.get(code)
@@ -0,0 +1,108 @@
+from functions.guidelines import Criterion, Guideline
+from functions.output_schemas import FIRST_DEGREE_RELATIVES
+from functions.rules import Decision, AllOf, AnyOf, Answer, Check
+
+ASSESSMENT = """
+                                Age: {age} \n
+                                Previous colonoscopy: {colonoscopy} \n
+                                First-degree history of colorectal cancer: {relatives}, Currently sympomatic: {symptomatic} \n
+                                Juvenile polyposis reported in the document: {juvenile_polyposis} \n
+                                \n
+                                Kind regards, \n
+                                Jasper
+                        """
+
+# Diagnostic colonoscopy: the verdict of the first rule that holds wins. The order
+# of the criteria within a rule only matters for which criteria have to be asked.
+GUIDELINE = Guideline(
+    cpt_code=45378,
+    name="Diagnostic colonoscopy",
+    criteria=[
+        Criterion(
+            "previous_success",
+            "Has there been a previous treatment that successfully improved colonalrectal or absominal discomfort? Answer with a yes or a no",
+            description="Previous sucessful treatment?: ",
+            status="Determining if there has been a successful treatment...",
+            one_shot_question="Has there been a previous treatment that successfully improved colorectal or abdominal discomfort?",
+        ),
+        Criterion(
+            "colonoscopy",
+            "Check if patient already had a colonoscopy in past 10 years, apart from one that is possible scheduled, yes or no?",
+            description="Already had a colonoscopy?: ",
+            status="Determining if there has already been a colonoscopy...",
+            one_shot_question="Has the patient already had a colonoscopy in the past 10 years, apart from one that is possibly scheduled?",
+        ),
+        Criterion(
+            "relatives",
+            "Is there any family history of colorectal cancer? If yes, answer just with the family relationship",
+            description="First-degree family history of colorectal cancer?: ",
+            status="Checking for colon cancer in first-degree family history...",
+            yes_no_question="Is there any family history of colorectal cancer in a first-degree relative (parent, sibling or child)? Answer just yes or no.",
+            one_shot_question="Is there a family history of colorectal cancer in a first-degree relative (parent, sibling or child)?",
+            schema=FIRST_DEGREE_RELATIVES,
+            # a relative mentioned in at least 25% of the samples counts as present
+            yes_share=0.25,
+            # the list of relatives takes more tokens than a yes or no
+            cost=1.5,
+        ),
+        Criterion(
+            "symptomatic",
+            "Is the patient symptomatic (e.g. abdominal pain, iron deficiency anemia, rectal bleeding)? Answer just yes or no.",
+            description="Is the patient symptomatic?: ",
+            status="Checking if the patient is symptomatic...",
+            one_shot_question="Is the patient symptomatic (e.g. abdominal pain, iron deficiency anemia, rectal bleeding)?",
+        ),
+        Criterion(
+            "juvenile_polyposis",
+            "Has the patient been diagnosed with juvenile polyposis syndrome? Answer just yes or no.",
+            description="Juvenile polyposis reported in the document?: ",
+            status="Checking for juvenile polyposis...",
+            one_shot_question="Has the patient been diagnosed with juvenile polyposis syndrome?",
+        ),
+    ],
+    decision=Decision(
+        [
+            (Answer("previous_success", "Yes"), "previously_treated"),
+            (
+                AnyOf(
+                    Answer("juvenile_polyposis", "Yes"),
+                    AllOf(Check("age", lambda age: age > 45), Answer("colonoscopy", "No")),
+                    AllOf(
+                        Check("age", lambda age: age >= 40),
+                        Answer("symptomatic", "Yes"),
+                        Answer("relatives", "Yes"),
+                    ),
+                ),
+                "advised",
+            ),
+        ],
+        default="not_required",
+    ),
+    letters={
+        "previously_treated": """
+                            Assessment complete. \n
+                            \n
+                            Dear Sir/Madam,\n
+                            \n
+                            The patient has been treated successfully, diagnostic colonoscopy (CPT code: 45378) may not be required. \n
+                            Please get in touch if you have any questions. \n
+                            \n
+                            Kind regards, \n
+                            Jasper
+                            """,
+        "advised": """
+                                Assessment complete. \n
+                                \n
+                                Dear Sir/Madam,
+                                \n
+                                Diagnostic colonoscopy (CPT code: 45378) is advised: \n \n"""
+        + ASSESSMENT,
+        "not_required": """
+                                Assessment complete.
+                                \n
+                                Dear Sir/Madam,\n
+                                \n
+                                Diagnostic colonoscopy (CPT code: 45378) may not be required.: \n \n"""
+        + ASSESSMENT,
+    },
+)
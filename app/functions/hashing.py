@@ -0,0 +1,41 @@
+import hashlib
+
+
+def hash_files(file_paths):
+    """
+    Hash the bytes of a list of files, their names don't matter: the same document
+    uploaded under another name hits the same cache entries.
+
+    A single file hashes to the sha256 of its bytes (see uploads.save_upload), several
+    files to the packet_hash of their digests, so their order doesn't matter either.
+
+    Parameters:
+    file_paths (list of str): The documents to hash.
+
+    Returns:
+    str: A hex sha256 digest of the file contents.
+    """
+    digests = []
+    for file_path in file_paths:
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        digests.append(digest.hexdigest())
+    if len(digests) == 1:
+        return digests[0]
+    return packet_hash(digests)
+
+
+def packet_hash(document_hashes):
+    """
+    Hash of a packet of documents from their hash_files([path]) digests, so the
+    packet doesn't have to be read again when one document changes.
+
+    Parameters:
+    document_hashes (iterable of str): The digests of the documents.
+    """
+    digest = hashlib.sha256()
+    for document_hash in sorted(document_hashes):
+        digest.update(document_hash.encode("utf-8"))
+    return digest.hexdigest()
@@ -0,0 +1,293 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from functions.cancellation import Cancelled
+from functions.hashing import packet_hash
+
+logger = logging.getLogger(__name__)
+
+ASSESSMENT_HISTORY_PATH = os.environ.get("ASSESSMENT_HISTORY_PATH", "./cache/history.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    hash TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    first_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS assessments (
+    id INTEGER PRIMARY KEY,
+    packet_hash TEXT,
+    cpt_code INTEGER,
+    recommendation TEXT,
+    mode TEXT,
+    confidence_mode TEXT,
+    state TEXT NOT NULL,
+    error TEXT,
+    letter TEXT,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assessments_started_at ON assessments (started_at);
+CREATE INDEX IF NOT EXISTS assessments_cpt_code ON assessments (cpt_code, started_at);
+CREATE INDEX IF NOT EXISTS assessments_packet_hash ON assessments (packet_hash);
+CREATE TABLE IF NOT EXISTS assessment_documents (
+    assessment_id INTEGER NOT NULL REFERENCES assessments (id),
+    document_hash TEXT NOT NULL REFERENCES documents (hash),
+    PRIMARY KEY (assessment_id, document_hash)
+);
+CREATE INDEX IF NOT EXISTS assessment_documents_hash
+    ON assessment_documents (document_hash, assessment_id);
+CREATE TABLE IF NOT EXISTS criteria_answers (
+    assessment_id INTEGER NOT NULL REFERENCES assessments (id),
+    criterion TEXT NOT NULL,
+    description TEXT,
+    answer TEXT,
+    confidence TEXT,
+    samples TEXT,
+    PRIMARY KEY (assessment_id, criterion)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    assessment_id INTEGER NOT NULL REFERENCES assessments (id),
+    stage TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    response TEXT,
+    answer TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_assessment ON samples (assessment_id);
+CREATE TABLE IF NOT EXISTS timings (
+    assessment_id INTEGER NOT NULL REFERENCES assessments (id),
+    criterion TEXT,
+    phase TEXT NOT NULL,
+    iteration INTEGER,
+    seconds REAL NOT NULL,
+    tokens INTEGER
+);
+CREATE INDEX IF NOT EXISTS timings_assessment ON timings (assessment_id);
+"""
+
+
+def _text(value):
+    # answers are strings, numbers, lists of relatives or dicts (one-shot samples)
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+
+class AssessmentHistory:
+    """
+    Every assessment that was run, in a sqlite file: the documents it was run on,
+    the verdict and letter, the answer per criterion, the raw samples of the model
+    and the timings.
+
+    The file is in WAL mode, so the dashboard workers and batch runs can read the
+    history while another process writes to it. Assessments are looked up by
+    document hash, CPT code and date through indexes, and read a page at a time.
+
+    Parameters:
+    path (str, optional): Location of the sqlite file.
+    """
+
+    def __init__(self, path=ASSESSMENT_HISTORY_PATH):
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # waits for the write lock of other processes instead of failing at once
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def record(self, progress, results, document_hashes, state="finished", error=None,
+               mode=None, confidence_mode=None, started_at=None, finished_at=None):
+        """
+        Store an assessment.
+
+        Parameters:
+        progress (ProgressStore): The progress store the assessment reported to.
+        results (dict): Return value of run_assessment, empty if it didn't finish.
+        document_hashes (dict): path -> hash_files([path]) of the assessed documents.
+        state (str, optional): "finished", "failed" or "cancelled".
+        error (str, optional): Why the assessment failed.
+        mode (str, optional): Assessment mode, see run_assessment.
+        confidence_mode (str, optional): "vote" or "logprob".
+        started_at (float, optional): Start time, defaults to 'finished_at'.
+        finished_at (float, optional): End time, defaults to now.
+
+        Returns:
+        int: Id of the assessment.
+        """
+        finished_at = finished_at or time.time()
+        started_at = started_at or finished_at
+        code = results.get("code")
+        letter = progress.get_status()[1].strip() if results else None
+
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO documents (hash, filename, first_seen) VALUES (?, ?, ?)",
+                [(h, os.path.basename(path), started_at) for path, h in document_hashes.items()],
+            )
+            assessment_id = self._db.execute(
+                "INSERT INTO assessments (packet_hash, cpt_code, recommendation, mode, "
+                "confidence_mode, state, error, letter, started_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    packet_hash(document_hashes.values()) if document_hashes else None,
+                    code if isinstance(code, int) else None,
+                    results.get("recommendation"), mode, confidence_mode, state, error,
+                    letter, started_at, finished_at,
+                ),
+            ).lastrowid
+            self._db.executemany(
+                "INSERT OR IGNORE INTO assessment_documents (assessment_id, document_hash) "
+                "VALUES (?, ?)",
+                [(assessment_id, h) for h in set(document_hashes.values())],
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO criteria_answers "
+                "(assessment_id, criterion, description, answer, confidence, samples) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (assessment_id, row["criterion"] or row["desc"], row["desc"],
+                     _text(row["output"]), _text(row["confidence"]), _text(row["samples"]))
+                    for row in progress.get_results()[1]
+                ],
+            )
+            self._db.executemany(
+                "INSERT INTO samples (assessment_id, stage, iteration, response, answer) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (assessment_id, s["stage"], s["iteration"], s["response"], _text(s["answer"]))
+                    for s in list(progress.samples)
+                ],
+            )
+            self._db.executemany(
+                "INSERT INTO timings (assessment_id, criterion, phase, iteration, seconds, tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (assessment_id, t["criterion"], t["phase"], t["iteration"], t["seconds"],
+                     t["tokens"])
+                    for t in list(progress.timing_records)
+                ],
+            )
+        return assessment_id
+
+    def _where(self, cpt_code, document_hash, since, until):
+        clauses, params = [], []
+        if cpt_code is not None:
+            clauses.append("a.cpt_code = ?")
+            params.append(cpt_code)
+        if document_hash:
+            # a prefix of the hash is enough, as a range it can use the index
+            clauses.append(
+                "a.id IN (SELECT assessment_id FROM assessment_documents "
+                "WHERE document_hash >= ? AND document_hash < ?)"
+            )
+            params += [document_hash, document_hash + "\uffff"]
+        if since is not None:
+            clauses.append("a.started_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("a.started_at < ?")
+            params.append(until)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def count(self, cpt_code=None, document_hash=None, since=None, until=None):
+        """Number of assessments that match the filters, see page."""
+        where, params = self._where(cpt_code, document_hash, since, until)
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM assessments a{where}", params).fetchone()[0]
+
+    def page(self, offset=0, limit=20, cpt_code=None, document_hash=None, since=None, until=None):
+        """
+        One page of assessments, newest first.
+
+        Parameters:
+        offset (int, optional): Assessments to skip.
+        limit (int, optional): Size of the page.
+        cpt_code (int, optional): Only assessments of this CPT code.
+        document_hash (str, optional): Only assessments of a document whose hash starts with this.
+        since (float, optional): Only assessments started at or after this time.
+        until (float, optional): Only assessments started before this time.
+
+        Returns:
+        list of dict: The assessments, with the filenames of their documents.
+        """
+        where, params = self._where(cpt_code, document_hash, since, until)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT a.id, a.cpt_code, a.recommendation, a.mode, a.confidence_mode, a.state, "
+                "a.started_at, a.finished_at, "
+                "(SELECT group_concat(d.filename, ', ') FROM assessment_documents ad "
+                " JOIN documents d ON d.hash = ad.document_hash "
+                " WHERE ad.assessment_id = a.id) AS documents "
+                f"FROM assessments a{where} ORDER BY a.started_at DESC LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def assessment(self, assessment_id):
+        """An assessment with its documents, criteria answers, samples and timings, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM assessments WHERE id = ?", (assessment_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            details = dict(row)
+            for table, query in [
+                ("documents", "SELECT d.* FROM assessment_documents ad "
+                              "JOIN documents d ON d.hash = ad.document_hash WHERE ad.assessment_id = ?"),
+                ("criteria", "SELECT * FROM criteria_answers WHERE assessment_id = ?"),
+                ("samples", "SELECT * FROM samples WHERE assessment_id = ? ORDER BY rowid"),
+                ("timings", "SELECT * FROM timings WHERE assessment_id = ? ORDER BY rowid"),
+            ]:
+                details[table] = [dict(r) for r in self._db.execute(query, (assessment_id,))]
+        return details
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history():
+    """Return the process-wide assessment history, opening it on first use."""
+    global _history
+    with _history_lock:
+        if _history is None:
+            _history = AssessmentHistory()
+        return _history
+
+
+@contextmanager
+def recorded(progress, document_hashes, mode=None, confidence_mode=None):
+    """
+    Record the assessment run inside this block in the history, also when it fails or is
+    cancelled. The block puts the return value of run_assessment in run["results"].
+    """
+    run = {"results": {}}
+    started_at = time.time()
+    state, error = "failed", None
+    try:
+        yield run
+        state = "finished"
+    except Cancelled:
+        state = "cancelled"
+        raise
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        # the history is a record, it doesn't fail the assessment itself
+        try:
+            get_history().record(
+                progress, run["results"], document_hashes, state=state, error=error,
+                mode=mode, confidence_mode=confidence_mode, started_at=started_at,
+            )
+        except sqlite3.Error:
+            logger.exception("Could not record the assessment in the history")
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from llama_index import (
+    SimpleDirectoryReader,
+    StorageContext,
+    VectorStoreIndex,
+    load_index_from_storage,
+)
+from llama_index.ingestion import run_transformations
+
+from functions.hashing import hash_files
+from functions.metrics import timed
+from functions.uploads import list_files
+
+logger = logging.getLogger(__name__)
+
+# Built indices are persisted here, one sub-directory per cache key.
+INDEX_CACHE_DIR = os.environ.get("INDEX_CACHE_DIR", "./cache/index")
+
+# Least recently used indices are evicted once the cache grows beyond this.
+INDEX_CACHE_MAX_BYTES = int(os.environ.get("INDEX_CACHE_MAX_BYTES", 512 * 1024**2))
+
+
+def index_cache_key(content_hash, chunk_size, embed_model_name):
+    """
+    Build the cache key for an index from the document hash and the settings
+    that change the embeddings (chunk size and embedding model).
+    """
+    key = f"{content_hash}:{chunk_size}:{embed_model_name}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def evict_index_cache(cache_dir=INDEX_CACHE_DIR, max_bytes=INDEX_CACHE_MAX_BYTES):
+    """
+    Remove the least recently used indices until the cache fits in 'max_bytes'.
+
+    The modification time of an entry is refreshed on every cache hit, so it
+    doubles as the last-used time.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.startswith("."):
+            entries.append((os.path.getmtime(path), _directory_size(path), path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        logger.info("Index cache: evicting %s (%d bytes)", path, size)
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def load_or_build_index(input_files, service_context, chunk_size, embed_model_name,
+                        cache_dir=INDEX_CACHE_DIR, content_hash=None):
+    """
+    Load the vector index for 'input_files' from the on-disk cache,
+    or build and persist it on a cache miss.
+
+    Parameters:
+    input_files (list of str): The documents to index.
+    service_context (ServiceContext): llama-index service context used for embedding.
+    chunk_size (int): Chunk size the service context was configured with.
+    embed_model_name (str): Name of the embedding model, part of the cache key.
+    cache_dir (str, optional): Root directory of the index cache.
+    content_hash (str, optional): hash_files(input_files) if it is already known.
+
+    Returns:
+    VectorStoreIndex: The loaded or freshly built index.
+    """
+    key = index_cache_key(content_hash or hash_files(input_files), chunk_size, embed_model_name)
+    persist_dir = os.path.join(cache_dir, key)
+
+    if os.path.isdir(persist_dir):
+        start = time.perf_counter()
+        with timed("index_load"):
+            storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+            index = load_index_from_storage(storage_context, service_context=service_context)
+        os.utime(persist_dir)  # mark as recently used
+        logger.info(
+            "Index cache hit for %s (loaded in %.2fs)", key[:12], time.perf_counter() - start
+        )
+        return index
+
+    logger.info("Index cache miss for %s, building index", key[:12])
+    start = time.perf_counter()
+    with timed("document_load"):
+        documents = SimpleDirectoryReader(input_files=input_files).load_data()
+    # chunking and embedding are timed through the service context's callbacks
+    index = VectorStoreIndex.from_documents(documents, service_context=service_context)
+
+    # persist to a temporary directory first so a crash never leaves a half-written entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = os.path.join(cache_dir, f".tmp-{key}-{os.getpid()}")
+    index.storage_context.persist(persist_dir=tmp_dir)
+    try:
+        os.rename(tmp_dir, persist_dir)
+    except OSError:
+        # another process stored the same index in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    logger.info(
+        "Index for %s built and cached in %.2fs", key[:12], time.perf_counter() - start
+    )
+
+    evict_index_cache(cache_dir)
+    return index
+
+
+# documents of a packet index (content hash -> file and ref doc ids) and its settings
+PACKET_MANIFEST = "packet.json"
+
+
+def _read_manifest(index_dir):
+    try:
+        with open(os.path.join(index_dir, PACKET_MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def update_packet_index(index_dir, input_files, service_context, chunk_size, embed_model_name,
+                        document_hashes=None):
+    """
+    Bring the index of a packet of documents (e.g. all referral documents of a patient)
+    up to date with 'input_files', inserting and deleting single documents.
+
+    Every document is tracked by its content hash: an unchanged document is left as
+    it is, a new one is chunked, embedded and inserted, and the nodes of a document
+    that was removed or replaced are deleted. If nothing changed the index is only
+    loaded. The index is rebuilt if it was built with a different chunk size or
+    embedding model.
+
+    Parameters:
+    index_dir (str): Where the packet's index is persisted.
+    input_files (list of str): The documents currently in the packet.
+    service_context (ServiceContext): llama-index service context used for embedding.
+    chunk_size (int): Chunk size the service context was configured with.
+    embed_model_name (str): Name of the embedding model.
+    document_hashes (dict, optional): path -> hash_files([path]) for documents whose
+                                      hash is already known.
+
+    Returns:
+    VectorStoreIndex: The up to date index.
+    """
+    document_hashes = document_hashes or {}
+    current = {}
+    for file_path in input_files:
+        document_hash = document_hashes.get(file_path) or hash_files([file_path])
+        current[document_hash] = file_path
+
+    settings = f"{chunk_size}:{embed_model_name}"
+    manifest = _read_manifest(index_dir)
+    if manifest is not None and manifest["settings"] == settings:
+        with timed("index_load"):
+            storage_context = StorageContext.from_defaults(persist_dir=index_dir)
+            index = load_index_from_storage(storage_context, service_context=service_context)
+        documents = manifest["documents"]
+    else:
+        index = VectorStoreIndex([], service_context=service_context)
+        documents = {}
+
+    removed = [document_hash for document_hash in documents if document_hash not in current]
+    added = [document_hash for document_hash in current if document_hash not in documents]
+    if not removed and not added and manifest is not None:
+        return index
+
+    start = time.perf_counter()
+    for document_hash in removed:
+        for ref_doc_id in documents.pop(document_hash)["ref_doc_ids"]:
+            index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+
+    new_documents = []
+    for document_hash in added:
+        with timed("document_load"):
+            pages = SimpleDirectoryReader(input_files=[current[document_hash]]).load_data()
+        for i, page in enumerate(pages):
+            # stable ids, so the nodes of a document can be found again by its hash
+            page.id_ = f"{document_hash}:{i}"
+        documents[document_hash] = {
+            "file": os.path.basename(current[document_hash]),
+            "ref_doc_ids": [page.id_ for page in pages],
+        }
+        new_documents.extend(pages)
+    if new_documents:
+        # chunking and embedding are timed through the service context's callbacks,
+        # the nodes of all new documents are embedded in the same batches
+        nodes = run_transformations(new_documents, service_context.transformations)
+        index.insert_nodes(nodes)
+
+    # persist next to the old index and swap, so a crash never leaves a half-written index
+    tmp_dir = f"{index_dir}.tmp-{os.getpid()}"
+    index.storage_context.persist(persist_dir=tmp_dir)
+    with open(os.path.join(tmp_dir, PACKET_MANIFEST), "w") as f:
+        json.dump({"settings": settings, "documents": documents}, f)
+    old_dir = f"{index_dir}.old-{os.getpid()}"
+    if os.path.isdir(index_dir):
+        os.rename(index_dir, old_dir)
+    os.rename(tmp_dir, index_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    logger.info(
+        "Packet index %s: %d document(s) added, %d removed in %.2fs",
+        index_dir, len(added), len(removed), time.perf_counter() - start,
+    )
+    return index
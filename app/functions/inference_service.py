@@ -0,0 +1,408 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.llms import CompletionResponse, CustomLLM, LLMMetadata
+from llama_index.llms.base import llm_completion_callback
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+
+from functions import metrics
+from functions.cancellation import CancelToken, Cancelled, cancellable, current_token
+from functions.jobs import JobManager
+from functions.output_schemas import OutputSchema, constrained_output, current_schema
+
+logger = logging.getLogger(__name__)
+
+# Shared secret of the server and its clients. Requests are pickled, so whoever can
+# connect can run code in the model process: there is no default, the server and the
+# clients refuse to run without it.
+INFERENCE_SERVER_AUTHKEY = os.environ.get("INFERENCE_SERVER_AUTHKEY", "").encode("utf-8") or None
+
+# embedding requests that arrive within this many seconds are embedded together
+EMBED_BATCH_WAIT = float(os.environ.get("EMBED_BATCH_WAIT", 0.01))
+
+# texts embedded in one call at most
+EMBED_BATCH_MAX_TEXTS = int(os.environ.get("EMBED_BATCH_MAX_TEXTS", 256))
+
+# how often a waiting client checks whether its request was cancelled
+CANCEL_POLL_SECONDS = 0.05
+
+
+def _require_authkey(authkey):
+    if not authkey:
+        raise ValueError(
+            "Set INFERENCE_SERVER_AUTHKEY to the same secret for the inference server and its clients."
+        )
+    return authkey
+
+
+def parse_address(address):
+    """"host:port" for a TCP socket on this machine, anything else is a unix socket path."""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+class _TimingCollector:
+    # receives the timings of a request on the server, like a ProgressStore would
+    def __init__(self):
+        self.rows = []
+
+    def timing(self, phase, criterion, seconds, tokens=None, iteration=None):
+        self.rows.append((phase, seconds, tokens))
+
+
+class InferenceServer:
+    """
+    Owns the LLM and the embedding model and serves them to other processes (web
+    workers, batch runs) over a local socket, so the weights are in memory once.
+
+    Every client connection is served by its own thread. Generations take turns on the
+    model (see SerializedLlamaCPP) and can be cancelled by the client between tokens.
+    Embedding requests of all clients go through one queue and are embedded together
+    in batches, questions as well as chunks.
+
+    The server also runs the dashboard's assessment jobs, so every web worker sees the
+    same queue, progress and cancel tokens (see RemoteJobManager).
+
+    Parameters:
+    address (str or tuple): Where to listen, see parse_address.
+    authkey (bytes): Shared secret, defaults to INFERENCE_SERVER_AUTHKEY.
+    llm (LLM, optional): Defaults to model_registry's local LLM.
+    embed_model (BaseEmbedding, optional): Defaults to model_registry's local embedding model.
+    scorer (TokenProbabilityScorer, optional): Defaults to model_registry's scorer,
+                                               created on the first logprob request.
+    jobs (JobManager, optional): Runs the dashboard's assessments, on this server's models.
+    """
+
+    def __init__(self, address, authkey=INFERENCE_SERVER_AUTHKEY, llm=None, embed_model=None,
+                 scorer=None, jobs=None):
+        self.address = address
+        self.authkey = _require_authkey(authkey)
+        self.llm = llm
+        self.embed_model = embed_model
+        self.scorer = scorer
+        self.jobs = jobs or JobManager()
+        self._embed_queue = queue.Queue()
+        self._cancel_tokens = {}
+        self._schemas = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def start(self):
+        """Load the models and listen, requests are served by background threads."""
+        if self.llm is None or self.embed_model is None:
+            from functions import model_registry
+
+            self.llm = self.llm or model_registry.get_llm()
+            self.embed_model = self.embed_model or model_registry.get_embed_model()
+        self._listener = Listener(self.address, authkey=self.authkey)
+        if isinstance(self.address, str):
+            # only this user can connect to the unix socket
+            os.chmod(self.address, 0o600)
+        threading.Thread(target=self._embed_batches, name="embed-batches", daemon=True).start()
+        threading.Thread(target=self._accept, name="accept", daemon=True).start()
+        logger.info("Inference server listening on %s", self.address)
+
+    def serve_forever(self):
+        self.start()
+        while True:
+            time.sleep(3600)
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                # e.g. a client with the wrong authkey
+                logger.exception("Inference server: rejected a connection")
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    request_id, op, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ("ok", getattr(self, f"_op_{op}")(request_id, *args))
+                except Cancelled:
+                    reply = ("cancelled", None)
+                except Exception as e:
+                    logger.exception("Inference server: %s request failed", op)
+                    reply = ("error", f"{type(e).__name__}: {e}")
+                try:
+                    conn.send(reply)
+                except (EOFError, OSError):
+                    return
+
+    def _schema(self, spec):
+        # grammars are compiled once per schema, see OutputSchema.compiled_grammar
+        if spec is None:
+            return None
+        name, grammar, max_tokens = spec
+        with self._lock:
+            schema = self._schemas.get(spec)
+            if schema is None:
+                schema = self._schemas[spec] = OutputSchema(name, grammar, max_tokens, None, None)
+        return schema
+
+    def _op_complete(self, request_id, prompt, formatted, schema_spec):
+        token = CancelToken()
+        with self._lock:
+            self._cancel_tokens[request_id] = token
+        collector = _TimingCollector()
+        try:
+            with metrics.recording(collector), cancellable(token), \
+                    constrained_output(self._schema(schema_spec)):
+                text = self.llm.complete(prompt, formatted=formatted).text
+        finally:
+            with self._lock:
+                self._cancel_tokens.pop(request_id, None)
+        return text, collector.rows
+
+    def _op_cancel(self, request_id, cancelled_id):
+        with self._lock:
+            token = self._cancel_tokens.get(cancelled_id)
+        if token is not None:
+            token.cancel()
+
+    def _op_embed(self, request_id, kind, texts):
+        future = Future()
+        self._embed_queue.put((kind, texts, future))
+        return future.result()
+
+    def _embed_batches(self):
+        while True:
+            batch = [self._embed_queue.get()]
+            # collect what the other clients ask for in the meantime
+            deadline = time.perf_counter() + EMBED_BATCH_WAIT
+            n_texts = len(batch[0][1])
+            while n_texts < EMBED_BATCH_MAX_TEXTS:
+                try:
+                    request = self._embed_queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n_texts += len(request[1])
+
+            for kind in ("query", "text"):
+                requests = [request for request in batch if request[0] == kind]
+                if requests:
+                    self._embed(kind, requests)
+
+    def _embed(self, kind, requests):
+        texts = [text for _, request_texts, _ in requests for text in request_texts]
+        try:
+            if kind == "query" and hasattr(self.embed_model, "get_query_embedding_batch"):
+                vectors = self.embed_model.get_query_embedding_batch(texts)
+            elif kind == "query":
+                vectors = [self.embed_model.get_query_embedding(text) for text in texts]
+            else:
+                vectors = self.embed_model.get_text_embedding_batch(texts)
+        except Exception as e:
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+        start = 0
+        for _, request_texts, future in requests:
+            future.set_result(vectors[start:start + len(request_texts)])
+            start += len(request_texts)
+
+    def _op_yes_probability(self, request_id, question, context_texts):
+        if self.scorer is None:
+            from functions import model_registry
+
+            self.scorer = model_registry.get_scorer()
+        nodes = [NodeWithScore(node=TextNode(text=text)) for text in context_texts]
+        return self.scorer.yes_probability(question, nodes)
+
+    def _op_stats(self, request_id):
+        from functions import model_registry
+
+        return {
+            "prefix_cache": model_registry.prefix_cache_stats(),
+            "embedding_cache": model_registry.embedding_cache_stats(),
+        }
+
+    def _op_metrics(self, request_id):
+        # the dashboard's assessments run here, so do their timings
+        return metrics.registry.render()
+
+    # the dashboard's jobs, jobs are passed to the clients as Job.snapshot()
+
+    def _job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise KeyError(f"Unknown job '{job_id}'.")
+        return job
+
+    def _op_job_create(self, request_id):
+        return self.jobs.create_job().snapshot()
+
+    def _op_job_get(self, request_id, job_id):
+        job = self.jobs.get(job_id)
+        return None if job is None else job.snapshot()
+
+    def _op_job_add_document(self, request_id, job_id, path, content_hash):
+        self.jobs.add_document(job_id, path, content_hash)
+
+    def _op_job_submit(self, request_id, job_id, options):
+        return self.jobs.submit(job_id, **options).snapshot()
+
+    def _op_job_cancel(self, request_id, job_id):
+        return self.jobs.cancel(job_id)
+
+    def _op_job_queue_position(self, request_id, job_id):
+        return self.jobs.queue_position(self._job(job_id))
+
+    def _op_job_stats(self, request_id):
+        return self.jobs.stats()
+
+    def _op_job_progress(self, request_id, job_id, read):
+        if read not in ("get_status", "get_results", "get_timings"):
+            raise ValueError(f"Unknown progress read: {read}")
+        return getattr(self._job(job_id).progress, read)()
+
+
+class InferenceClient:
+    """
+    Sends requests to an InferenceServer, over one connection per thread.
+
+    Parameters:
+    address (str or tuple): Address of the server, see parse_address.
+    authkey (bytes): Shared secret, defaults to INFERENCE_SERVER_AUTHKEY.
+    """
+
+    def __init__(self, address, authkey=INFERENCE_SERVER_AUTHKEY):
+        self.address = address
+        self.authkey = _require_authkey(authkey)
+        self._local = threading.local()
+        self._ids = itertools.count()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Client(self.address, authkey=self.authkey)
+        return conn
+
+    def call(self, op, *args, token=None):
+        """
+        Run 'op' on the server and return its result. Setting 'token' while waiting
+        cancels the request on the server, 'call' then raises Cancelled.
+        """
+        request_id = f"{os.getpid()}-{next(self._ids)}"
+        try:
+            conn = self._connection()
+            conn.send((request_id, op, args))
+            cancel_sent = False
+            while not conn.poll(CANCEL_POLL_SECONDS):
+                if token is not None and token.is_set() and not cancel_sent:
+                    # on a second connection, this one is busy with the request
+                    with Client(self.address, authkey=self.authkey) as cancel_conn:
+                        cancel_conn.send((None, "cancel", (request_id,)))
+                        cancel_conn.recv()
+                    cancel_sent = True
+            status, result = conn.recv()
+        except (EOFError, OSError) as e:
+            # reconnect on the next call, e.g. after the server restarted
+            self._local.conn = None
+            raise ConnectionError(f"Inference server at {self.address} is not reachable: {e}") from e
+
+        if status == "cancelled":
+            raise Cancelled()
+        if status == "error":
+            raise RuntimeError(f"Inference server: {result}")
+        return result
+
+
+class RemoteLLM(CustomLLM):
+    """
+    The LLM of an InferenceServer. Output schemas, cancel tokens and the prompt
+    evaluation and generation timings are passed on as if the model were local.
+    """
+
+    context_window: int = 3900
+    num_output: int = 256
+    model_name: str = "remote"
+
+    _client: InferenceClient = PrivateAttr()
+
+    def __init__(self, client, **kwargs):
+        super().__init__(**kwargs)
+        self._client = client
+
+    @classmethod
+    def class_name(cls):
+        return "RemoteLLM"
+
+    @property
+    def metadata(self):
+        return LLMMetadata(
+            context_window=self.context_window, num_output=self.num_output, model_name=self.model_name
+        )
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        schema = current_schema()
+        token = current_token()
+        if token is not None:
+            token.check()
+        spec = None if schema is None else (schema.name, schema.grammar, schema.max_tokens)
+        text, timings = self._client.call("complete", prompt, formatted, spec, token=token)
+        for phase, seconds, tokens in timings:
+            metrics.record(phase, seconds, tokens)
+        return CompletionResponse(text=text)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        response = self.complete(prompt, formatted=formatted, **kwargs)
+        yield CompletionResponse(text=response.text, delta=response.text)
+
+
+class RemoteEmbedding(BaseEmbedding):
+    """The embedding model of an InferenceServer, which batches the requests of all clients."""
+
+    _client: InferenceClient = PrivateAttr()
+
+    def __init__(self, client, **kwargs):
+        super().__init__(**kwargs)
+        self._client = client
+
+    @classmethod
+    def class_name(cls):
+        return "RemoteEmbedding"
+
+    def _get_query_embedding(self, query):
+        return self._client.call("embed", "query", [query])[0]
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._client.call("embed", "text", list(texts))
+
+
+class RemoteScorer:
+    """TokenProbabilityScorer on the model of an InferenceServer, retrieval stays local."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def score(self, query_engine, question):
+        nodes = query_engine.retrieve(QueryBundle(question))
+        texts = [node.node.get_content() for node in nodes]
+        return self.client.call("yes_probability", question, texts, token=current_token())
@@ -0,0 +1,416 @@
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+from functions.progress import ProgressStore
+from functions.cancellation import CancelToken, Cancelled
+from functions.scheduler import default_max_workers
+from functions.uploads import list_files
+from functions.history import recorded
+from functions.hashing import hash_files
+
+logger = logging.getLogger(__name__)
+
+# every job gets its own upload area below this directory
+JOBS_DIR = os.environ.get("JOBS_DIR", "./app/data/jobs")
+
+# number of assessments that run at the same time against the shared models
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 1))
+
+# finished jobs (and their uploads) are removed after this many seconds
+JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_SECONDS", 24 * 3600))
+
+
+class Job:
+    """
+    A single assessment: its upload area, its progress/result store and its timing.
+
+    States: "created" -> "queued" -> "running" -> "done", "failed" or "cancelled".
+    Submitting a job again starts a new run, a run that is still queued or running
+    is cancelled and superseded by it. Every run reports to its own progress store,
+    'progress' is the one of the latest run, the one the dashboard shows.
+    """
+
+    def __init__(self, job_id, data_dir):
+        self.id = job_id
+        self.data_dir = data_dir
+        # the index of the uploaded documents, updated document by document
+        self.index_dir = os.path.join(data_dir, ".index")
+        self.progress = ProgressStore()
+        self.state = "created"
+        self.error = None
+        self.options = {}
+        # cancel token and number of the latest run
+        self.cancel_token = CancelToken()
+        self.run_id = 0
+        # held while a run executes, so a superseded run has stopped before the next starts
+        self.run_lock = threading.Lock()
+        # path -> hash of every uploaded document, computed while it streamed in
+        self.document_hashes = {}
+        self.created_at = time.time()
+        self.submitted_at = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def wait_time(self):
+        """Seconds the job waited (or has been waiting) in the queue."""
+        if self.submitted_at is None:
+            return 0.0
+        return (self.started_at or time.time()) - self.submitted_at
+
+    @property
+    def is_active(self):
+        return self.state in ("queued", "running")
+
+    def snapshot(self):
+        """The job's current state as plain values, see RemoteJob."""
+        return {
+            "id": self.id, "data_dir": self.data_dir, "state": self.state, "error": self.error,
+            "run_id": self.run_id, "wait_time": self.wait_time,
+        }
+
+
+def run_assessment_job(job, cancelled, progress, options):
+    """
+    Index the job's upload and run the assessment, results go to the run's 'progress'
+    store. The run stops (raising Cancelled) once the 'cancelled' token is set.
+    """
+    from functions import metrics, model_registry
+    from functions.extraction import read_pdf_text
+    from functions.medical_assessment import run_assessment
+    from functions.response_cache import get_response_cache
+
+    progress.stage_started("index", "Loading the models and indexing the document...")
+    try:
+        # The LLM and embedding model are loaded once per process (by the first job,
+        # or at startup with EAGER_MODEL_LOAD=1), only the index is built per job.
+        with metrics.recording(progress, criterion="index"):
+            input_files = list_files(job.data_dir)
+            query_engine = model_registry.build_query_engine(
+                input_files=input_files,
+                refresh_responses=options.get("refresh_responses", False),
+                index_dir=job.index_dir,
+                document_hashes=job.document_hashes,
+            )
+            with metrics.timed("document_load"):
+                document_text = read_pdf_text(input_files)
+    finally:
+        progress.stage_finished("index")
+
+    # every run, finished or not, is kept in the assessment history
+    document_hashes = {path: job.document_hashes.get(path) or hash_files([path]) for path in input_files}
+    with recorded(
+        progress, document_hashes, mode=options.get("mode", "per_criterion"),
+        confidence_mode=options.get("confidence_mode", "vote"),
+    ) as run:
+        run["results"] = run_assessment(
+            query_engine,
+            progress,
+            max_workers=default_max_workers(model_registry.MODEL_CONTEXTS),
+            model_contexts=model_registry.MODEL_CONTEXTS,
+            document_text=document_text,
+            scorer=model_registry.get_scorer()
+            if options.get("confidence_mode") == "logprob"
+            else None,
+            mode=options.get("mode", "per_criterion"),
+            cancelled=cancelled,
+        )
+    logger.info("Response cache after job %s: %s", job.id, get_response_cache().stats())
+    logger.info("Prompt prefix cache after job %s: %s", job.id, model_registry.prefix_cache_stats())
+    logger.info("Embedding cache after job %s: %s", job.id, model_registry.embedding_cache_stats())
+
+
+class JobManager:
+    """
+    Queues assessment jobs and runs them on a fixed number of worker threads.
+
+    Jobs live in the memory of this process. Several web workers share the jobs of
+    one process through an InferenceServer, which runs them (see RemoteJobManager).
+
+    Parameters:
+    run_job (callable): Runs a single job, receives the Job, the CancelToken of the run
+                        (set when the run is cancelled or superseded), and the run's
+                        own ProgressStore and options.
+    max_concurrent (int, optional): Number of jobs running at the same time.
+    jobs_dir (str, optional): Root directory of the per-job upload areas.
+    """
+
+    def __init__(self, run_job=run_assessment_job, max_concurrent=MAX_CONCURRENT_JOBS,
+                 jobs_dir=JOBS_DIR):
+        self.run_job = run_job
+        self.max_concurrent = max_concurrent
+        self.jobs_dir = jobs_dir
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._wait_times = []
+
+    def _start_workers(self):
+        # started lazily so that importing the app doesn't spawn threads
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.max_concurrent):
+                worker = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def create_job(self):
+        """Create a new job with an empty upload area."""
+        self._prune()
+        job_id = uuid.uuid4().hex
+        # absolute, web workers in other directories write the uploads there
+        data_dir = os.path.abspath(os.path.join(self.jobs_dir, job_id))
+        os.makedirs(data_dir)
+        job = Job(job_id, data_dir)
+        with self._lock:
+            self._jobs[job_id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def add_document(self, job_id, path, content_hash):
+        """Add an uploaded document, hashed while it streamed in, to the job's packet."""
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(f"Unknown job '{job_id}'.")
+        job.document_hashes[path] = content_hash
+
+    def submit(self, job_id, **options):
+        """
+        Queue a job for assessment, with a fresh progress store in place of the one of
+        the previous run. Keyword arguments are stored in 'job.options' for the run.
+
+        A run of the job that is still queued or running is cancelled, it is
+        superseded by the new one.
+        """
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(f"Unknown job '{job_id}'.")
+
+        with self._lock:
+            superseded = job.is_active
+            job.cancel_token.cancel()
+            job.cancel_token = CancelToken()
+            job.run_id += 1
+            # a superseded run keeps reporting to its own store until it has stopped
+            job.progress = ProgressStore()
+            job.options = options
+            job.error = None
+            job.started_at = job.finished_at = None
+            job.submitted_at = time.time()
+            job.state = "queued"
+            run = (job, job.run_id, job.cancel_token, job.progress, options)
+        if superseded:
+            logger.info("Job %s: cancelling the previous run, superseded by run %d", job.id, job.run_id)
+        self._start_workers()
+        self._queue.put(run)
+        logger.info("Job %s queued (queue depth %d)", job.id, self.queue_depth())
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancel the queued or running run of a job. A running assessment stops after
+        the token that is being generated.
+
+        Returns:
+        bool: False if the job had nothing to cancel.
+        """
+        job = self.get(job_id)
+        if job is None or not job.is_active:
+            return False
+        with self._lock:
+            job.cancel_token.cancel()
+            if job.state == "queued":
+                # never started, the worker skips it
+                self._finish(job, "cancelled")
+        logger.info("Job %s: cancel requested", job.id)
+        return True
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished_at = time.time()
+        if state == "cancelled":
+            job.progress.set_status("Assessment cancelled.")
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def queue_position(self, job):
+        """1-based position of a queued job, None if it is not waiting."""
+        if job.state != "queued":
+            return None
+        with self._queue.mutex:
+            # runs that were cancelled while waiting are skipped by the workers
+            waiting = [run[0] for run in self._queue.queue if not run[2].is_set()]
+        return waiting.index(job) + 1 if job in waiting else None
+
+    def stats(self):
+        """Queue depth, running jobs and the average wait of the jobs started so far."""
+        with self._lock:
+            running = sum(job.state == "running" for job in self._jobs.values())
+            waits = list(self._wait_times)
+        return {
+            "queued": self.queue_depth(),
+            "running": running,
+            "max_concurrent": self.max_concurrent,
+            "average_wait": sum(waits) / len(waits) if waits else 0.0,
+        }
+
+    def _work(self):
+        while True:
+            job, run_id, token, progress, options = self._queue.get()
+            try:
+                self._run(job, run_id, token, progress, options)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job, run_id, token, progress, options):
+        with job.run_lock:
+            with self._lock:
+                # cancelled or superseded while waiting
+                if token.is_set():
+                    return
+                job.started_at = time.time()
+                job.state = "running"
+                self._wait_times = (self._wait_times + [job.wait_time])[-100:]
+            logger.info("Job %s started after waiting %.1fs", job.id, job.wait_time)
+
+            state, error = "done", None
+            try:
+                self.run_job(job, token, progress, options)
+            except Cancelled:
+                state = "cancelled"
+            except Exception as e:
+                logger.exception("Job %s failed", job.id)
+                state, error = "failed", e
+            if state == "done" and token.is_set():
+                # finished anyway, e.g. the cancel arrived during the last generation
+                state = "cancelled"
+
+            with self._lock:
+                # a superseding run owns the job's state now
+                if run_id != job.run_id:
+                    logger.info("Job %s: superseded run %d stopped", job.id, run_id)
+                    return
+                if error is not None:
+                    job.error = str(error)
+                    progress.set_status(f"Assessment failed: {error}")
+                self._finish(job, state)
+            logger.info("Job %s %s", job.id, state)
+
+    def _prune(self):
+        # remove finished jobs and their uploads once they are old enough
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        with self._lock:
+            expired = [
+                job for job in self._jobs.values()
+                if not job.is_active and (job.finished_at or job.created_at) < cutoff
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            shutil.rmtree(job.data_dir, ignore_errors=True)
+
+
+class RemoteProgress:
+    """Reads the ProgressStore of the latest run of a job that runs in an InferenceServer."""
+
+    def __init__(self, client, job_id):
+        self._client = client
+        self._job_id = job_id
+
+    def _read(self, name):
+        return self._client.call("job_progress", self._job_id, name)
+
+    def get_status(self):
+        return self._read("get_status")
+
+    def get_results(self):
+        return self._read("get_results")
+
+    def get_timings(self):
+        return self._read("get_timings")
+
+
+class RemoteJob:
+    """A Job that runs in an InferenceServer, as it was when it was fetched."""
+
+    def __init__(self, client, snapshot):
+        self.id = snapshot["id"]
+        self.data_dir = snapshot["data_dir"]
+        self.state = snapshot["state"]
+        self.error = snapshot["error"]
+        self.run_id = snapshot["run_id"]
+        self.wait_time = snapshot["wait_time"]
+        self.progress = RemoteProgress(client, self.id)
+
+    @property
+    def is_active(self):
+        return self.state in ("queued", "running")
+
+
+class RemoteJobManager:
+    """
+    The JobManager of an InferenceServer. Queue, progress and cancel tokens of every job
+    live in the server, so any web worker can serve any session. Uploads are written
+    to the job's directory by the web worker, on the server's machine.
+
+    Parameters:
+    address (str): Address of the server, see inference_service.parse_address.
+    authkey (bytes, optional): Shared secret, defaults to INFERENCE_SERVER_AUTHKEY.
+    """
+
+    def __init__(self, address, authkey=None):
+        self.address = address
+        self.authkey = authkey
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # the client module imports the ML stack, only when the first request comes in
+        with self._lock:
+            if self._client is None:
+                from functions.inference_service import (
+                    INFERENCE_SERVER_AUTHKEY,
+                    InferenceClient,
+                    parse_address,
+                )
+
+                self._client = InferenceClient(
+                    parse_address(self.address), self.authkey or INFERENCE_SERVER_AUTHKEY
+                )
+            return self._client
+
+    def _job(self, snapshot):
+        return None if snapshot is None else RemoteJob(self.client, snapshot)
+
+    def create_job(self):
+        return self._job(self.client.call("job_create"))
+
+    def get(self, job_id):
+        return self._job(self.client.call("job_get", job_id))
+
+    def add_document(self, job_id, path, content_hash):
+        self.client.call("job_add_document", job_id, path, content_hash)
+
+    def submit(self, job_id, **options):
+        return self._job(self.client.call("job_submit", job_id, options))
+
+    def cancel(self, job_id):
+        return self.client.call("job_cancel", job_id)
+
+    def queue_position(self, job):
+        return self.client.call("job_queue_position", job.id)
+
+    def stats(self):
+        return self.client.call("job_stats")
@@ -62,6 +62,24 @@ def count_yes_no(strings):
     return yes_count, no_count
 
 
+def parse_yes_no(text):
+    """
+    Reads a single yes/no answer with the same rules as count_yes_no.
+
+    Parameters:
+    text (str): A single llm response.
+
+    Returns:
+    bool or None: True for 'Yes', False for 'No', None if neither is found in the first five tokens.
+    """
+    yes_count, no_count = count_yes_no([text])
+    if yes_count:
+        return True
+    if no_count:
+        return False
+    return None
+
+
 def calculate_age(dob_string, reference_date=None):
     """
     Calculate the age of a patient based on their date of birth extracted from a given string.
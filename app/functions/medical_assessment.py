@@ -1,279 +1,277 @@
-from functions.llm_output_functions import *
-
-
-def run_assessment(query_engine, temp_csv):
-
-    # Number of iterations for confidence check
-    n_iterations = 9
-
-    while True:
-        # Update status
-        with open("status.txt", "w") as status_file:
-            status_file.write(
-                "First, we extract code for requested treatment... (Please be patient)"
-            )
-
-        response = query_engine.query(
-            """Hospitals use CPT codes to treatments, 
-                                      these codes are 5 digits. Can you identify any of these codes 
-                                      related to treatments in this report?"""
-        )
-        text = response.response
-
-        code_present, code = check_for_cpt_code(text)
-        with open(temp_csv, "a") as file:
-            file.write("desc,confidence,output\n")
-            file.write(
-                f"CPT code for the requested treatment,-,{code}\n"
-            )  # Example data
-
-        if code != 45378:
-            break
-
-        # --------Check age of patient----------------------------
-        # now lets get the age of the patient, because this will be relevant later:
-        response = query_engine.query(
-            """What is the date of birth of the patient in this report?
- """
-        )
-
-        # Example usage
-        dob_string = response.response
-        # Calculate age as of today,
-        # We can also insert the date at which the report was created in calculate_age().
-        age = calculate_age(dob_string)
-        age_present = check_age(age)  # check if valid number
-        with open(temp_csv, "a") as file:
-            file.write(f"Patients age is: ,-,{age}\n")  # Example data
-
-        # -------------check if there has been a successful treatment---------------
-        # run the model 'n_iterations' times to check if there was a previous successful treatment.
-        # multiple iterations help the model to be more accurate due to inherent noise.
-        #   It also helps flush out different formats of responses that dont
-        #   work so well for my hack-y string detection code.
-
-        # write status
-        with open("status.txt", "w") as status_file:
-            status_file.write("Determining if there has been a successful treatment...")
-
-        checks = []
-        for i in range(n_iterations):
-            response = query_engine.query(
-                "Has there been a previous treatment that successfully improved colonalrectal or absominal discomfort? Answer with a yes or a no"
-            )
-            checks.append(response.response)
-
-            # update status
-            with open("status.txt", "w") as status_file:
-                status_file.write(
-                    f"Determining if there has been a successful treatment... {i+1}/{n_iterations}"
-                )
-        yes_count, no_count = count_yes_no(checks)
-
-        # check if successfully treated.
-        result_previous_success, perc_successfully_treated = evaluate_success(
-            yes_count, no_count
-        )
+import threading
 
-        # write results in dash table
-        with open(temp_csv, "a") as file:
-            file.write(
-                f"Previous sucessful treatment?: ,{perc_successfully_treated},{result_previous_success}\n"
-            )  # Example data
-
-        # if successfully treated, break
-        if result_previous_success == "Yes":
-            break
-
-        # ------------If 45 or older check if they already had a colonoscopy----------------
-        #
-        if age >= 45:
-            checks = []
-            for i in range(n_iterations):
-                response = query_engine.query(
-                    "Check if patient already had a colonoscopy in past 10 years, apart from one that is possible scheduled, yes or no?"
-                )
-                checks.append(response.response)
-
-                # update status
-                with open("status.txt", "w") as status_file:
-                    status_file.write(
-                        f"Determining if there has already been a colonoscopy... {i+1}/{n_iterations}"
-                    )
-
-            yes_count, no_count = count_yes_no(checks)
-            result_already_had_colonoscopy, colonoscopy_perc = evaluate_success(
-                yes_count, no_count
-            )
-
-            # write results in dash table
-            with open(temp_csv, "a") as file:
-                file.write(
-                    f"Already had a colonoscopy?: ,{colonoscopy_perc},{result_already_had_colonoscopy}\n"
-                )  # Example data
-        else:
-            result_already_had_colonoscopy = "N/A"
-        # -------------If 40 or older check the following---------------
-        # -------------CHeck if there is any family history of colorectal cancer---------------
-
-        if age >= 40:
-            checks = []
-            relative_yn = []
-            for i in range(n_iterations):
-                response = query_engine.query(
-                    "Is there any family history of colorectal cancer? If yes, answer just with the family relationship"
-                )
-                checks.append(response.response)
-
-                relative_present, relative = detect_first_degree_relative(
-                    response.response
-                )
-                relative_yn.append(relative_present)
-
-                # update status
-                with open("status.txt", "w") as status_file:
-                    status_file.write(
-                        f"Checking for colon cancer in first-degree family history... {i+1}/{n_iterations}"
-                    )
-
-            # if we detect less than 25% of the time, we can assume they dont have colonoscopy
-            #   check if first degree history:
-            if sum(relative_yn) / len(relative_yn) < 0.25:
-                result_relatives = "No"
-                confidence = (1 - sum(relative_yn) / len(relative_yn)) * 100
-            else:
-                result_relatives = "Yes"
-                confidence = (sum(relative_yn) / len(relative_yn)) * 100
-
-            confidence_str = f"{confidence} % sure"  # flip
-
-            with open(temp_csv, "a") as file:
-                file.write(
-                    f"First-degree family history of colorectal cancer?: ,{confidence_str},{result_relatives}\n"
-                )  # Example data
-
-            # ------------- Check if symptomatic ---------------
-
-            checks = []
-            for i in range(n_iterations):
-                response = query_engine.query(
-                    "Is the patient symptomatic (e.g. abdominal pain, iron deficiency anemia, rectal bleeding)? Answer just yes or no."
-                )
-                checks.append(response.response)
-
-                # update status
-                with open("status.txt", "w") as status_file:
-                    status_file.write(
-                        f"Checking if the patient is symptomatic... {i+1}/{n_iterations}"
-                    )
-
-            yes_count, no_count = count_yes_no(checks)
-            result_symptomatic, sympomatic_perc = evaluate_success(yes_count, no_count)
-
-            with open(temp_csv, "a") as file:
-                file.write(
-                    f"Is the patient symptomatic?: ,{sympomatic_perc},{result_symptomatic}\n"
-                )  # Example data
-        else:
-            result_symptomatic = "N/A"
-            relative_present = "N/A"
-        # ------------- Juvenile polyposis ---------------
-
-        checks = []
-        for i in range(n_iterations):
-            response = query_engine.query(
-                "Check if patient already had a colonoscopy in past 10 years, apart from one that is possible scheduled, yes or no?"
-            )
-            checks.append(response.response)
-
-            # update status
-            with open("status.txt", "w") as status_file:
-                status_file.write(
-                    f"Determining if there has already been a colonoscopy... {i+1}/{n_iterations}"
-                )
-
-        yes_count, no_count = count_yes_no(checks)
-        result_juv, juv_polyposis_perc = evaluate_success(yes_count, no_count)
-
-        # write results in dash table
-        with open(temp_csv, "a") as file:
-            file.write(
-                f"Juvenile polyposis reported in the document?: ,{juv_polyposis_perc},{result_juv}\n"
-            )  # Example data
-
-        break
-
-    if code != 45378:
-        # update status
-        with open("status.txt", "w") as status_file:
-            status_file.write(
-                f"""
-                            
-                            Assessment complete. 
+from functions.llm_output_functions import *
+from functions.sampling import iter_samples, AdaptiveVote
+from functions.scheduler import RuleScheduler
+from functions.guidelines import plan_for
+from functions.extraction import extract_cpt_code, extract_date_of_birth
+from functions.token_confidence import ProbabilityVote
+from functions.one_shot import ask_all_criteria
+from functions.metrics import recording, timed
+from functions.cancellation import CancelToken, cancellable
+from functions.output_schemas import constrained_output, CPT_CODE, DATE
+
+# letter for a procedure without a guideline
+NO_GUIDELINE_LETTER = """
+
+                            Assessment complete.
                             \n
                             Dear Sir/Madam, \n
                             \n
-                            The patient does not request a diagnostic colonoscopy (CPT code: 45378).\n
+                            There is no guideline for the requested treatment (CPT code: {code}).\n
                             \n
                             Kind regards,
-                            Jasper                          
+                            Jasper
                             """
-            )
 
-    elif result_previous_success == "Yes":
-        with open("status.txt", "w") as status_file:
-            status_file.write(
-                f""" 
-                            Assessment complete. \n
-                            \n 
-                            Dear Sir/Madam,\n
-                            \n
-                            The patient has been treated successfully, diagnostic colonoscopy (CPT code: 45378) may not be required. \n
-                            Please get in touch if you have any questions. \n
-                            \n
-                            Kind regards, \n
-                            Jasper                          
-                            """
-            )
 
-    elif (
-        ((age > 45) & (result_already_had_colonoscopy == "No"))
-        | (result_juv == "Yes")
-        | ((age >= 40) & (result_relatives == "Yes") & (result_symptomatic == "Yes"))
-    ):
-        with open("status.txt", "w") as status_file:
-            status_file.write(
-                f""" 
-                                Assessment complete. \n
-                                \n 
-                                Dear Sir/Madam,
-                                \n
-                                Diagnostic colonoscopy (CPT code: 45378) is advised: \n \n
-                                Age: {age} \n
-                                Previous colonoscopy: {result_already_had_colonoscopy} \n
-                                First-degree history of colorectal cancer: {result_relatives}, Currently sympomatic: {result_symptomatic} \n
-                                Juvenile polyposis reported in the document: {result_juv} \n 
-                                \n
-                                Kind regards, \n
-                                Jasper                          
-                        """
+def ask_repeatedly(query_engine, question, progress, stage, status, schema, decide, n_iterations,
+                   shared_retrieval, confidence_bound, cancelled, constrained=True):
+    """
+    Ask a question up to 'n_iterations' times and vote over the parsed answers.
+
+    Parameters:
+    query_engine (RetrieverQueryEngine): The query engine over the documents.
+    question (str): The question to ask.
+    progress (ProgressStore): Receives an iteration event for every sample.
+    stage (str): Name of the criterion, used for the progress events.
+    status (str): Status message, the iteration count is appended to it.
+    schema (OutputSchema): Shape of the answer, parses a response text into a vote.
+    decide (callable): Decision rule of the vote, see AdaptiveVote.
+    n_iterations (int): Maximum number of samples.
+    shared_retrieval (bool): Retrieve once and only repeat the generation.
+    confidence_bound (float or None): Early stopping bound, see AdaptiveVote.
+    cancelled (threading.Event or CancelToken): Stop sampling when set.
+    constrained (bool, optional): Enforce the schema while generating. Defaults to True.
+
+    Returns:
+    AdaptiveVote: The tally of the votes.
+    """
+    vote = AdaptiveVote(n_iterations, decide=decide, confidence_bound=confidence_bound)
+    with constrained_output(schema if constrained else None):
+        for i, text in enumerate(
+            iter_samples(query_engine, question, n_iterations, shared_retrieval)
+        ):
+            with timed("parsing"):
+                answer = schema.parse(text)
+            vote.add(answer)
+            progress.sample(stage, i + 1, text, answer)
+
+            # update status
+            progress.iteration(stage, i + 1, n_iterations, status)
+            if vote.is_decided() or cancelled.is_set():
+                break
+    return vote
+
+
+def run_assessment(query_engine, progress, shared_retrieval=True, confidence_bound=None,
+                   max_workers=1, document_text=None, scorer=None, constrained=True,
+                   mode="per_criterion", cancelled=None, model_contexts=1):
+    """
+    Assess whether the requested procedure is advised for the documents behind 'query_engine'.
+
+    The CPT code of the requested procedure is extracted first and selects the
+    guideline (see functions.guidelines) whose criteria are assessed. Progress, result
+    rows and the final letter are published to 'progress'. If the 'document_text' is
+    given, the CPT code and date of birth are first looked up in it directly and the
+    LLM is only asked when that lookup finds nothing or is ambiguous.
+
+    By default the confidence of a yes/no criterion is the share of up to 9 sampled
+    answers that agree. With a TokenProbabilityScorer as 'scorer', it is instead the
+    probability of the "Yes"/"No" answer token from a single forward pass.
+
+    With 'constrained' the answers are generated under a grammar (Yes/No, a list of
+    relatives, a 5-digit code or a date) and stop after a few tokens.
+
+    In the "one_shot" 'mode' the yes/no criteria are not asked one by one: the nodes
+    of all their questions are retrieved together and a single prompt asks for a JSON
+    object with every answer, sampled up to 9 times with a vote per criterion.
+
+    Criteria are evaluated lazily against the guideline's decision: a criterion is
+    only asked while its answer can still change the recommendation, so e.g. a patient
+    under 40 is never asked about relatives or symptoms. Criteria that weren't needed
+    are listed as "Skipped".
+
+    With more than one of 'max_workers', criteria further down the line are asked
+    speculatively while the model has one of its 'model_contexts' to spare. A model
+    that generates one answer at a time (the default) never speculates.
+
+    Setting the 'cancelled' CancelToken stops the assessment after the current
+    generated token, run_assessment then raises Cancelled.
+
+    Returns:
+    dict: The answer of every criterion that was answered (keyed by criterion name),
+          the 'recommendation' (a verdict of the guideline, or "no_guideline" if
+          there is none for the CPT code) and the 'skipped' criteria.
+    """
+
+    # Maximum number of iterations for confidence check
+    n_iterations = 9
+    # With shared_retrieval the nodes for each question are retrieved once and only
+    # the generation is repeated for the n_iterations samples.
+    # Sampling stops early once the majority can no longer flip, or once the
+    # winning answer reaches 'confidence_bound' (see AdaptiveVote).
+
+    if mode not in ("per_criterion", "one_shot"):
+        raise ValueError(f"Unknown assessment mode: {mode}")
+    if mode == "one_shot" and scorer is not None:
+        raise ValueError("The one-shot mode can't be combined with token probability scoring.")
+
+    # The criteria of the guideline are only asked while their answer can still change
+    # its verdict, the cheapest first, on 'max_workers' threads. Once the verdict is
+    # known everything that hasn't finished yet is cancelled.
+    scheduler = RuleScheduler(max_workers, abort=cancelled, model_contexts=model_contexts)
+    # stops a criterion once its answer isn't needed anymore, or the run is cancelled
+    stop = CancelToken(*(token for token in (scheduler.cancelled, cancelled) if token is not None))
+
+    # status shown on the dashboard while a criterion runs
+    status_messages = {
+        "code": "First, we extract code for requested treatment... (Please be patient)",
+        "age": "Extracting the date of birth of the patient...",
+        "all_criteria": "Answering all criteria at once...",
+    }
+
+    # row label of every criterion in the results table
+    descriptions = {
+        "code": "CPT code for the requested treatment",
+        "age": "Patients age is: ",
+    }
+    # answers of the criteria that were answered, as opposed to skipped or cancelled.
+    # A criterion that was asked speculatively can still finish after the verdict.
+    answered = {}
+
+    def report(name, confidence, samples, answer):
+        answered[name] = answer
+        progress.result(descriptions[name], confidence, samples, answer, criterion=name)
+
+    def stage(name, fn):
+        # wrap a criterion so the dashboard sees when it starts and finishes
+        def run_stage(results):
+            progress.stage_started(name, status_messages[name])
+            try:
+                # timings below are tagged with the criterion, see functions.metrics
+                with recording(progress, criterion=name), cancellable(stop):
+                    return fn(results)
+            finally:
+                progress.stage_finished(name)
+
+        return run_stage
+
+    def cpt_code(results):
+        # a code on the letter's request line doesn't need the LLM
+        code = extract_cpt_code(document_text) if document_text else None
+        if code is not None:
+            report("code", "text match", "0", code)
+            return code
+
+        with constrained_output(CPT_CODE if constrained else None):
+            response = query_engine.query(
+                """Hospitals use CPT codes to treatments, 
+                                      these codes are 5 digits. Can you identify any of these codes 
+                                      related to treatments in this report?"""
             )
+        with timed("parsing"):
+            code = CPT_CODE.parse(response.response)
+        report("code", "-", "-", code)
+        return code
+
+    # the guideline is picked by the code, so the code is always found first
+    code = stage("code", cpt_code)({})
+    stop.check()
+    plan = plan_for(code)
+    if plan is None:
+        progress.set_status(NO_GUIDELINE_LETTER.format(code=code))
+        return {"code": code, "recommendation": "no_guideline", "skipped": []}
+
+    for name, criterion in plan.criteria.items():
+        status_messages[name] = criterion.status
+        descriptions[name] = criterion.description
+
+    def patient_age(results):
+        # now lets get the age of the patient, because this will be relevant later:
+        dob = extract_date_of_birth(document_text) if document_text else None
+        if dob is not None:
+            age = calculate_age(dob.strftime("%m/%d/%Y"))
+            report("age", "text match", "0", age)
+            return age
 
-    else:
-        with open("status.txt", "w") as status_file:
-            status_file.write(
-                f""" 
-                                Assessment complete. 
-                                \n
-                                Dear Sir/Madam,\n
-                                \n
-                                Diagnostic colonoscopy (CPT code: 45378) may not be required.: \n \n
-                                Age: {age} \n
-                                Previous colonoscopy: {result_already_had_colonoscopy} \n
-                                First-degree history of colorectal cancer: {result_relatives}, Currently sympomatic: {result_symptomatic} \n
-                                Juvenile polyposis reported in the document: {result_juv} \n 
-                                \n
-                                Kind regards, \n
-                                Jasper                          
-                        """
+        with constrained_output(DATE if constrained else None):
+            response = query_engine.query(
+                """What is the date of birth of the patient in this report?
+ """
             )
+        # Calculate age as of today,
+        # We can also insert the date at which the report was created in calculate_age().
+        with timed("parsing"):
+            dob = DATE.parse(response.response)
+        if dob is None:
+            # "Unknown" or no valid date, rules on the age then don't hold
+            report("age", "-", "-", "Unknown")
+            return None
+        age = calculate_age(dob)
+        report("age", "-", "-", age)
+        return age
+
+    one_shot = {}
+    one_shot_lock = threading.Lock()
+
+    def all_criteria(results):
+        votes = ask_all_criteria(
+            query_engine, plan.joint, n_iterations, progress, "all_criteria",
+            status_messages["all_criteria"], stop, confidence_bound, constrained,
+            decide=plan.decide,
+        )
+        return None if stop.is_set() else votes
+
+    def ask(criterion, results):
+        if mode == "one_shot":
+            # the first criterion that is asked answers all of them in one pass
+            with one_shot_lock:
+                if "votes" not in one_shot:
+                    one_shot["votes"] = stage("all_criteria", all_criteria)(results)
+            votes = one_shot["votes"]
+            return None if votes is None else votes[criterion.name]
+
+        if scorer is not None:
+            # token probability mode, one forward pass instead of n_iterations samples
+            vote = ProbabilityVote(scorer.score(query_engine, criterion.yes_no_question))
+            progress.iteration(criterion.name, 1, 1, criterion.status)
+            return None if stop.is_set() else vote
+
+        # run the model up to 'n_iterations' times, multiple iterations help the model
+        # to be more accurate due to inherent noise.
+        vote = ask_repeatedly(
+            query_engine, criterion.question, progress, criterion.name, criterion.status,
+            criterion.schema, criterion.decide, n_iterations, shared_retrieval,
+            confidence_bound, stop, constrained,
+        )
+        # a cancelled criterion doesn't report its partial vote
+        return None if stop.is_set() else vote
+
+    def assess(criterion):
+        def assess_criterion(results):
+            vote = ask(criterion, results)
+            if vote is None:
+                return None
+            result, confidence = criterion.summarize(vote)
+            report(criterion.name, confidence, f"{vote.samples}/{vote.max_samples}", result)
+            return result
+
+        return assess_criterion
+
+    # expected cost of every criterion in LLM calls, cheaper criteria are asked first
+    samples = 1 if scorer is not None else n_iterations
+    scheduler.add("age", stage("age", patient_age), cost=1)
+    for name, criterion in plan.criteria.items():
+        scheduler.add(name, stage(name, assess(criterion)), cost=criterion.cost * samples)
+    recommendation, _ = scheduler.run(plan.decision)
+
+    # criteria that couldn't change the recommendation are listed as skipped
+    skipped = [name for name in descriptions if name not in answered]
+    for name in skipped:
+        progress.result(descriptions[name], "-", "-", "Skipped", criterion=name)
+
+    fields = {name: answered.get(name, "Skipped") for name in descriptions}
+    progress.set_status(plan.letters[recommendation].format(**fields))
+
+    return dict(answered, recommendation=recommendation, skipped=skipped)
@@ -0,0 +1,158 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from llama_index.callbacks import CallbackManager
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType
+
+# labels (criterion, iteration) of the work running in the current thread
+_labels = contextvars.ContextVar("metric_labels", default={})
+# ProgressStore of the assessment running in the current thread, if any
+_recorder = contextvars.ContextVar("metric_recorder", default=None)
+# number of retrievals open in the current thread, they include embedding the question
+_retrievals = contextvars.ContextVar("metric_retrievals", default=0)
+
+# llama-index events that are timed, and the phase they are reported as
+EVENT_PHASES = {
+    CBEventType.NODE_PARSING: "chunking",
+    CBEventType.EMBEDDING: "embedding",
+    CBEventType.RETRIEVE: "retrieval",
+    CBEventType.LLM: "llm",
+}
+
+
+class MetricsRegistry:
+    """
+    Process-wide totals of the time, calls and tokens spent per phase and criterion.
+
+    Phases: document_load, index_load, chunking, embedding (of the document chunks),
+    retrieval (includes embedding the question), llm, prompt_eval, generation and parsing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}  # (phase, criterion) -> [seconds, calls, tokens]
+
+    def add(self, phase, criterion, seconds, tokens):
+        with self._lock:
+            total = self._totals.setdefault((phase, criterion), [0.0, 0, 0])
+            total[0] += seconds
+            total[1] += 1
+            total[2] += tokens or 0
+
+    def render(self):
+        """The totals in the Prometheus text format."""
+        with self._lock:
+            totals = sorted(self._totals.items())
+        lines = [
+            "# HELP assessment_phase_seconds_total Time spent per phase and criterion.",
+            "# TYPE assessment_phase_seconds_total counter",
+        ]
+        lines += [
+            f'assessment_phase_seconds_total{{phase="{phase}",criterion="{criterion}"}} {total[0]:.6f}'
+            for (phase, criterion), total in totals
+        ]
+        lines += [
+            "# HELP assessment_phase_calls_total Number of timed calls per phase and criterion.",
+            "# TYPE assessment_phase_calls_total counter",
+        ]
+        lines += [
+            f'assessment_phase_calls_total{{phase="{phase}",criterion="{criterion}"}} {total[1]}'
+            for (phase, criterion), total in totals
+        ]
+        lines += [
+            "# HELP assessment_phase_tokens_total Tokens evaluated (prompt_eval) or generated (generation).",
+            "# TYPE assessment_phase_tokens_total counter",
+        ]
+        lines += [
+            f'assessment_phase_tokens_total{{phase="{phase}",criterion="{criterion}"}} {total[2]}'
+            for (phase, criterion), total in totals
+            if total[2]
+        ]
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def labels(**new_labels):
+    """Tag everything recorded in this block, e.g. with the criterion or the iteration."""
+    token = _labels.set({**_labels.get(), **new_labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+@contextmanager
+def recording(progress, **new_labels):
+    """Also record the timings of this block in the assessment's ProgressStore."""
+    token = _recorder.set(progress)
+    try:
+        with labels(**new_labels):
+            yield
+    finally:
+        _recorder.reset(token)
+
+
+def record(phase, seconds, tokens=None):
+    """Record 'seconds' (and 'tokens') spent in 'phase' under the current labels."""
+    current = _labels.get()
+    criterion = current.get("criterion", "none")
+    registry.add(phase, criterion, seconds, tokens)
+    progress = _recorder.get()
+    if progress is not None:
+        progress.timing(phase, criterion, seconds, tokens, current.get("iteration"))
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+
+class TimingCallbackHandler(BaseCallbackHandler):
+    """
+    Times the llama-index events listed in EVENT_PHASES. The question is embedded
+    inside a retrieval, that embedding is only counted as part of the retrieval.
+    """
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._starts = {}
+        self._lock = threading.Lock()
+
+    def on_event_start(self, event_type, payload=None, event_id="", parent_id="", **kwargs):
+        if event_type == CBEventType.RETRIEVE:
+            _retrievals.set(_retrievals.get() + 1)
+        elif event_type == CBEventType.EMBEDDING and _retrievals.get():
+            return event_id
+        if event_type in EVENT_PHASES:
+            with self._lock:
+                self._starts[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        if event_type == CBEventType.RETRIEVE:
+            _retrievals.set(max(0, _retrievals.get() - 1))
+        with self._lock:
+            start = self._starts.pop(event_id, None)
+        if start is not None:
+            record(EVENT_PHASES[event_type], time.perf_counter() - start)
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
+
+
+def callback_manager():
+    """A llama-index callback manager that reports the timed events."""
+    return CallbackManager([TimingCallbackHandler()])
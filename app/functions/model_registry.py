@@ -0,0 +1,307 @@
+import logging
+import os
+import threading
+
+import llama_cpp
+from llama_index import ServiceContext
+from llama_index.llms import LlamaCPP
+from llama_index.llms.llama_utils import messages_to_prompt, completion_to_prompt
+from langchain_community.embeddings.huggingface import HuggingFaceEmbeddings
+from llama_index.embeddings import LangchainEmbedding
+
+from functions.index_cache import load_or_build_index, update_packet_index, list_files
+from functions.hashing import hash_files, packet_hash
+from functions.response_cache import CachedQueryEngine, get_response_cache
+from functions.token_confidence import TokenProbabilityScorer
+from functions.output_schemas import current_schema
+from functions.cancellation import current_token
+from functions.prefix_cache import PrefixCache, PROMPT_CACHE_BYTES
+from functions.embedding_cache import CachedEmbedding, EMBED_BATCH_SIZE
+from functions.inference_service import (
+    InferenceClient,
+    RemoteLLM,
+    RemoteEmbedding,
+    RemoteScorer,
+    parse_address,
+)
+from functions import metrics
+
+logger = logging.getLogger(__name__)
+
+MODEL_URL = "https://huggingface.co/TheBloke/Mistral-7B-Instruct-v0.1-GGUF/resolve/main/mistral-7b-instruct-v0.1.Q5_K_M.gguf"
+TEMPERATURE = 0.1
+MAX_NEW_TOKENS = 256
+
+# settings that determine the embeddings, these are part of the index cache key
+CHUNK_SIZE = 1024
+EMBED_MODEL_NAME = "thenlper/gte-large"
+
+# cores used by every llama.cpp generation
+LLAMA_N_THREADS = int(os.environ.get("LLAMA_N_THREADS", max((os.cpu_count() or 2) // 2, 1)))
+
+# Address of a shared inference server ("host:port" or a unix socket path, see
+# app/inference_server.py). When set, the models live in that process and this one
+# only sends it requests, otherwise the models are loaded here.
+INFERENCE_SERVER_ADDRESS = os.environ.get("INFERENCE_SERVER_ADDRESS") or None
+
+# The models are loaded once per process and shared by every assessment.
+_llm = None
+_client = None
+_embed_model = None
+_service_context = None
+_scorer = None
+_lock = threading.Lock()
+
+# A llama.cpp context can only run one evaluation at a time.
+_generation_lock = threading.Lock()
+
+# llama.cpp contexts that generate side by side, sizes the criteria worker pool. There
+# is one, shared by every generation through _generation_lock (or the server's).
+MODEL_CONTEXTS = 1
+
+
+class SerializedLlamaCPP(LlamaCPP):
+    """
+    LlamaCPP that can be shared between threads.
+
+    Criteria that run concurrently overlap their retrieval and answer parsing,
+    but take turns on the model for the generation itself.
+
+    Answers generated inside a constrained_output block follow the grammar and
+    token cap of that output schema.
+
+    Every generation records its prompt evaluation and generation time and tokens,
+    see functions.metrics.
+
+    Generations inside a cancellable block stop after the current token once the
+    cancel token is set, and raise Cancelled.
+    """
+
+    def complete(self, *args, **kwargs):
+        schema = current_schema()
+        token = current_token()
+        overrides = {}
+        if schema is not None:
+            overrides.update(grammar=schema.compiled_grammar(), max_tokens=schema.max_tokens)
+        if token is not None:
+            # llama.cpp checks this after every generated token
+            overrides["stopping_criteria"] = llama_cpp.StoppingCriteriaList(
+                [lambda input_ids, logits: token.is_set()]
+            )
+
+        with _generation_lock:
+            # waiting for the model can take a while, the run may be cancelled by now
+            if token is not None:
+                token.check()
+            if not overrides:
+                return self._timed_complete(*args, **kwargs)
+
+            default_kwargs = dict(self.generate_kwargs)
+            self.generate_kwargs.update(overrides)
+            try:
+                response = self._timed_complete(*args, **kwargs)
+            finally:
+                self.generate_kwargs.clear()
+                self.generate_kwargs.update(default_kwargs)
+
+        # the answer of a generation that was stopped halfway is never used
+        if token is not None:
+            token.check()
+        return response
+
+    def _timed_complete(self, *args, **kwargs):
+        # llama.cpp's own counters split the call into prompt evaluation and generation
+        ctx = self._model._ctx.ctx
+        llama_cpp.llama_reset_timings(ctx)
+        response = super().complete(*args, **kwargs)
+        timings = llama_cpp.llama_get_timings(ctx)
+        metrics.record("prompt_eval", timings.t_p_eval_ms / 1000, timings.n_p_eval)
+        metrics.record("generation", timings.t_eval_ms / 1000, timings.n_eval)
+        return response
+
+    def stream_complete(self, *args, **kwargs):
+        # hold the lock until the stream is exhausted
+        with _generation_lock:
+            yield from super().stream_complete(*args, **kwargs)
+
+
+def _inference_client():
+    # called with _lock held
+    global _client
+    if _client is None:
+        logger.info("Using the inference server at %s", INFERENCE_SERVER_ADDRESS)
+        _client = InferenceClient(parse_address(INFERENCE_SERVER_ADDRESS))
+    return _client
+
+
+def get_llm():
+    """Return the process-wide LlamaCPP model, loading it on first use."""
+    global _llm
+    with _lock:
+        if _llm is None and INFERENCE_SERVER_ADDRESS:
+            _llm = RemoteLLM(
+                _inference_client(),
+                context_window=3900,
+                num_output=MAX_NEW_TOKENS,
+                model_name=os.path.basename(MODEL_URL),
+            )
+        if _llm is None:
+            logger.info("Loading LLM from %s", MODEL_URL)
+            _llm = SerializedLlamaCPP(
+                model_url=MODEL_URL,
+                model_path=None,
+                temperature=TEMPERATURE,
+                max_new_tokens=MAX_NEW_TOKENS,
+                context_window=3900,
+                generate_kwargs={},
+                model_kwargs={"n_gpu_layers": -1, "n_threads": LLAMA_N_THREADS},
+                messages_to_prompt=messages_to_prompt,
+                completion_to_prompt=completion_to_prompt,
+                verbose=True,
+            )
+            # keep the evaluated context of earlier prompts, see PrefixCache
+            if PROMPT_CACHE_BYTES > 0:
+                _llm._model.set_cache(PrefixCache(_llm._model))
+        return _llm
+
+
+def get_embed_model():
+    """Return the process-wide embedding model, loading it on first use."""
+    global _embed_model
+    with _lock:
+        if _embed_model is None and INFERENCE_SERVER_ADDRESS:
+            # the server caches the embeddings, see CachedEmbedding
+            _embed_model = RemoteEmbedding(
+                _inference_client(), model_name=EMBED_MODEL_NAME, embed_batch_size=EMBED_BATCH_SIZE
+            )
+        if _embed_model is None:
+            logger.info("Loading embedding model %s", EMBED_MODEL_NAME)
+            # chunks and questions that were embedded before are read from disk
+            _embed_model = CachedEmbedding(
+                LangchainEmbedding(
+                    HuggingFaceEmbeddings(model_name=EMBED_MODEL_NAME),
+                    embed_batch_size=EMBED_BATCH_SIZE,
+                ),
+                EMBED_MODEL_NAME,
+                # gte-large has no query instruction, see get_query_embedding_batch
+                symmetric=True,
+            )
+        return _embed_model
+
+
+def get_service_context():
+    """Return the shared service context wrapping the LLM and the embedding model."""
+    global _service_context
+    llm = get_llm()
+    embed_model = get_embed_model()
+    with _lock:
+        if _service_context is None:
+            _service_context = ServiceContext.from_defaults(
+                chunk_size=CHUNK_SIZE,
+                llm=llm,
+                embed_model=embed_model,
+                callback_manager=metrics.callback_manager(),
+            )
+        return _service_context
+
+
+def get_scorer():
+    """Return the token-probability scorer on top of the shared LLM."""
+    global _scorer
+    llm = get_llm()
+    with _lock:
+        if _scorer is None and INFERENCE_SERVER_ADDRESS:
+            _scorer = RemoteScorer(_inference_client())
+        if _scorer is None:
+            # shares the generation lock, the scorer evaluates on the same llama.cpp context
+            _scorer = TokenProbabilityScorer(llm, lock=_generation_lock)
+        return _scorer
+
+
+def prefix_cache_stats():
+    """How much of the prompts the LLM could skip evaluating, empty before the model is loaded."""
+    if _llm is None:
+        return {}
+    if INFERENCE_SERVER_ADDRESS:
+        return _client.call("stats")["prefix_cache"]
+    if _llm._model.cache is None:
+        return {}
+    return _llm._model.cache.stats()
+
+
+def embedding_cache_stats():
+    """Size and hit rate of the embedding cache, empty before the model is loaded."""
+    if _embed_model is None:
+        return {}
+    if INFERENCE_SERVER_ADDRESS:
+        return _client.call("stats")["embedding_cache"]
+    return _embed_model.stats()
+
+
+def warm_up():
+    """Load both models eagerly, e.g. from a background thread at startup."""
+    get_service_context()
+
+
+def model_settings():
+    """The settings that change what the LLM generates, part of the response cache key."""
+    return {
+        "model": os.path.basename(MODEL_URL),
+        "temperature": TEMPERATURE,
+        "max_new_tokens": MAX_NEW_TOKENS,
+    }
+
+
+def build_query_engine(data_dir=None, input_files=None, use_response_cache=True,
+                       refresh_responses=False, content_hash=None, index_dir=None,
+                       document_hashes=None):
+    """
+    Build a fresh query engine for a set of documents on top of the shared models.
+
+    Only the index is built per document (or loaded from the index cache),
+    the models themselves are never reloaded. With an 'index_dir' the documents are
+    a packet whose index is kept there and updated document by document instead,
+    see update_packet_index.
+
+    Parameters:
+    data_dir (str, optional): Directory containing the documents to assess.
+    input_files (list of str, optional): The documents to assess, instead of 'data_dir'.
+    use_response_cache (bool, optional): Cache the LLM responses for these documents.
+    refresh_responses (bool, optional): Generate fresh responses instead of reading cached ones.
+    content_hash (str, optional): hash_files(input_files), e.g. computed while uploading.
+    index_dir (str, optional): Where the index of the packet is kept.
+    document_hashes (dict, optional): path -> hash_files([path]) of the packet's documents,
+                                      e.g. computed while uploading.
+
+    Returns:
+    BaseQueryEngine: A query engine over the documents.
+    """
+    if input_files is None:
+        input_files = list_files(data_dir)
+    if not input_files:
+        raise ValueError("No documents to assess, please upload a pdf first.")
+    if index_dir is not None:
+        # every document is hashed once, for the packet index and the response cache
+        known = document_hashes or {}
+        document_hashes = {path: known.get(path) or hash_files([path]) for path in input_files}
+        content_hash = packet_hash(document_hashes.values())
+        index = update_packet_index(
+            index_dir, input_files, get_service_context(), CHUNK_SIZE, EMBED_MODEL_NAME,
+            document_hashes=document_hashes,
+        )
+    else:
+        content_hash = content_hash or hash_files(input_files)
+        index = load_or_build_index(
+            input_files, get_service_context(), CHUNK_SIZE, EMBED_MODEL_NAME,
+            content_hash=content_hash,
+        )
+    query_engine = index.as_query_engine()
+    if not use_response_cache:
+        return query_engine
+    return CachedQueryEngine(
+        query_engine,
+        get_response_cache(),
+        content_hash,
+        model_settings(),
+        refresh=refresh_responses,
+    )
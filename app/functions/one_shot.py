@@ -0,0 +1,145 @@
+import json
+import re
+
+from llama_index.schema import QueryBundle
+
+from functions.metrics import labels, timed
+from functions.output_schemas import OutputSchema, constrained_output
+from functions.sampling import AdaptiveVote, majority_vote
+
+# retrieved chunks put in front of the model, more would overflow the context window
+MAX_CONTEXT_NODES = 3
+
+
+def criteria_grammar(criteria):
+    """GBNF grammar of a JSON object with a "Yes"/"No" value for every criterion."""
+    members = ' "," ws '.join(f'"\\"{name}\\": " answer' for name, _ in criteria)
+    return "\n".join([
+        f'root ::= "{{" ws {members} ws "}}"',
+        'answer ::= "\\"Yes\\"" | "\\"No\\""',
+        "ws ::= [ \\n]*",
+    ])
+
+
+def validate_criteria(data, criteria):
+    """
+    Check a parsed answer against the schema: an object with exactly the criteria
+    as keys and "Yes" or "No" as values.
+
+    Returns:
+    dict or None: criterion -> True/False, or None if the answer doesn't match.
+    """
+    if not isinstance(data, dict) or set(data) != {name for name, _ in criteria}:
+        return None
+    if any(value not in ("Yes", "No") for value in data.values()):
+        return None
+    return {name: value == "Yes" for name, value in data.items()}
+
+
+def _parse_criteria(text, criteria):
+    try:
+        return validate_criteria(json.loads(text), criteria)
+    except ValueError:
+        return None
+
+
+def _find_criteria(text, criteria):
+    # unconstrained answers may wrap the object in prose
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    return _parse_criteria(match.group(), criteria) if match else None
+
+
+def build_prompt(criteria):
+    questions = "\n".join(f'- "{name}": {question}' for name, question in criteria)
+    return (
+        "Answer each of the following questions about the patient in this report with "
+        '"Yes" or "No". Respond with a single JSON object using these keys:\n' + questions
+    )
+
+
+def retrieve_union(query_engine, criteria, max_nodes=MAX_CONTEXT_NODES):
+    """Retrieve the nodes for every criterion once and keep the best scoring distinct nodes."""
+    best = {}
+    for _, question in criteria:
+        for node in query_engine.retrieve(QueryBundle(question)):
+            node_id = node.node.node_id
+            if node_id not in best or (node.score or 0) > (best[node_id].score or 0):
+                best[node_id] = node
+    ranked = sorted(best.values(), key=lambda node: node.score or 0, reverse=True)
+    return ranked[:max_nodes]
+
+
+class JointQuestion:
+    """
+    The single prompt that answers a set of yes/no criteria, with its output schema.
+    Built once per guideline, see functions.guidelines.
+
+    Parameters:
+    name (str): Name of the output schema, e.g. in the response cache key.
+    criteria (list of tuple): (criterion, question) pairs answered together.
+    """
+
+    def __init__(self, name, criteria):
+        self.criteria = criteria
+        self.prompt = build_prompt(criteria)
+        self.schema = OutputSchema(
+            name,
+            criteria_grammar(criteria),
+            # room for the keys and the quoted answers
+            max_tokens=16 + 16 * len(criteria),
+            parse=lambda text: _parse_criteria(text, criteria),
+            fallback=lambda text: _find_criteria(text, criteria),
+        )
+
+
+def ask_all_criteria(query_engine, joint, n_iterations, progress, stage, status, cancelled,
+                     confidence_bound=None, constrained=True, decide=None):
+    """
+    Answer all criteria with one prompt, sampled up to 'n_iterations' times.
+
+    Every sample is a JSON object validated against the joint schema, each criterion
+    keeps its own vote and sampling stops once every vote is decided.
+
+    Parameters:
+    query_engine (RetrieverQueryEngine): The query engine over the documents.
+    joint (JointQuestion): The criteria and their prompt.
+    n_iterations (int): Maximum number of samples.
+    progress (ProgressStore): Receives an iteration event for every sample.
+    stage (str): Name of the stage, used for the progress events.
+    status (str): Status message, the iteration count is appended to it.
+    cancelled (threading.Event or CancelToken): Stop sampling when set.
+    confidence_bound (float or None): Early stopping bound, see AdaptiveVote.
+    constrained (bool, optional): Enforce the JSON grammar while generating.
+    decide (dict, optional): Decision rule per criterion, defaults to majority_vote.
+
+    Returns:
+    dict: criterion -> AdaptiveVote.
+    """
+    decide = decide or {}
+    votes = {
+        name: AdaptiveVote(
+            n_iterations,
+            decide=decide.get(name, majority_vote),
+            confidence_bound=confidence_bound,
+        )
+        for name, _ in joint.criteria
+    }
+
+    nodes = retrieve_union(query_engine, joint.criteria)
+    query_bundle = QueryBundle(joint.prompt)
+    with constrained_output(joint.schema if constrained else None):
+        for i in range(n_iterations):
+            with labels(iteration=i + 1):
+                text = query_engine.synthesize(query_bundle, nodes).response
+                with timed("parsing"):
+                    answer = joint.schema.parse(text)
+            progress.sample(stage, i + 1, text, answer)
+            for name, vote in votes.items():
+                # an invalid answer counts as a sample without a vote for every criterion
+                if not vote.is_decided():
+                    vote.add(None if answer is None else answer[name])
+
+            progress.iteration(stage, i + 1, n_iterations, status)
+            if all(vote.is_decided() for vote in votes.values()) or cancelled.is_set():
+                break
+    return votes
@@ -0,0 +1,146 @@
+import contextvars
+import re
+from contextlib import contextmanager
+from datetime import datetime
+
+from functions.llm_output_functions import (
+    check_for_cpt_code,
+    detect_first_degree_relative,
+    parse_yes_no,
+)
+
+# schema of the answer that is being generated in the current thread
+_current_schema = contextvars.ContextVar("output_schema", default=None)
+
+
+class OutputSchema:
+    """
+    The shape of a short answer, enforced while the answer is generated.
+
+    Parameters:
+    name (str): Identifies the schema, e.g. in the response cache key.
+    grammar (str): llama.cpp GBNF grammar the generated text must follow.
+    max_tokens (int): Generation stops after this many tokens.
+    parse (callable): Turns a conforming answer into a value.
+    fallback (callable): Parses an answer that doesn't conform, e.g. when the
+                         backend ignores grammars.
+    """
+
+    def __init__(self, name, grammar, max_tokens, parse, fallback):
+        self.name = name
+        self.grammar = grammar
+        self.max_tokens = max_tokens
+        self.exact_parse = parse
+        self.fallback = fallback
+        self._compiled = None
+
+    def compiled_grammar(self):
+        """The grammar compiled for llama.cpp, compiled once on first use."""
+        if self._compiled is None:
+            from llama_cpp import LlamaGrammar
+
+            self._compiled = LlamaGrammar.from_string(self.grammar, verbose=False)
+        return self._compiled
+
+    def parse(self, text):
+        text = text.strip()
+        value = self.exact_parse(text)
+        return value if value is not None else self.fallback(text)
+
+
+@contextmanager
+def constrained_output(schema):
+    """Generate the answers inside this block according to 'schema'."""
+    token = _current_schema.set(schema)
+    try:
+        yield schema
+    finally:
+        _current_schema.reset(token)
+
+
+def current_schema():
+    """The schema set by constrained_output in this thread, or None."""
+    return _current_schema.get()
+
+
+def _exact_yes_no(text):
+    return {"Yes": True, "No": False}.get(text)
+
+
+FIRST_DEGREE = {"mother", "father", "brother", "sister", "son", "daughter"}
+
+
+def _exact_relatives(text):
+    if text == "None":
+        return False
+    relatives = text.split(", ")
+    # "other" stands for relatives that aren't first-degree
+    if not all(relative in FIRST_DEGREE or relative == "other" for relative in relatives):
+        return None
+    return any(relative in FIRST_DEGREE for relative in relatives)
+
+
+def _exact_cpt_code(text):
+    return int(text) if re.fullmatch(r"\d{5}", text) else None
+
+
+def _valid_date(text):
+    # the grammar still allows e.g. 02/31, only a real calendar date is an answer
+    try:
+        datetime.strptime(text, "%m/%d/%Y")
+    except ValueError:
+        return None
+    return text
+
+
+def _exact_date(text):
+    return _valid_date(text) if re.fullmatch(r"\d{2}/\d{2}/\d{4}", text) else None
+
+
+def _find_date(text):
+    # e.g. "Unknown" or a sentence around the date, None without a valid date
+    for match in re.findall(r"\b\d{2}/\d{2}/\d{4}\b", text):
+        if _valid_date(match):
+            return match
+    return None
+
+
+YES_NO = OutputSchema(
+    "yes_no",
+    'root ::= "Yes" | "No"',
+    max_tokens=3,
+    parse=_exact_yes_no,
+    fallback=parse_yes_no,
+)
+
+FIRST_DEGREE_RELATIVES = OutputSchema(
+    "first_degree_relatives",
+    r"""
+root ::= "None" | relative (", " relative)*
+relative ::= "mother" | "father" | "brother" | "sister" | "son" | "daughter" | "other"
+""",
+    max_tokens=16,
+    parse=_exact_relatives,
+    fallback=lambda text: detect_first_degree_relative(text)[0],
+)
+
+CPT_CODE = OutputSchema(
+    "cpt_code",
+    'root ::= [0-9] [0-9] [0-9] [0-9] [0-9] | "None"',
+    max_tokens=8,
+    parse=_exact_cpt_code,
+    fallback=lambda text: check_for_cpt_code(text)[1],
+)
+
+DATE = OutputSchema(
+    "date",
+    r"""
+root ::= month "/" day "/" year | "Unknown"
+month ::= "0" [1-9] | "1" [0-2]
+day ::= "0" [1-9] | [1-2] [0-9] | "3" [0-1]
+year ::= "19" [0-9] [0-9] | "20" [0-9] [0-9]
+""",
+    max_tokens=12,
+    parse=_exact_date,
+    fallback=_find_date,
+)
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+
+from llama_cpp import LlamaRAMCache
+
+from functions import metrics
+
+# Memory for saved llama.cpp states, 0 disables the cache. A state holds the KV cache of
+# one prompt, ~128 KiB per token for Mistral 7B, so the default keeps two states of a
+# full 3900 token context (more of shorter prompts).
+PROMPT_CACHE_BYTES = int(os.environ.get("LLAMA_PROMPT_CACHE_BYTES", 1 << 30))
+
+# a lookup only counts as a hit when it skips at least this many tokens, every prompt
+# shares the first few tokens of the prompt template
+PREFIX_HIT_MIN_TOKENS = int(os.environ.get("LLAMA_PREFIX_HIT_MIN_TOKENS", 32))
+
+
+def common_prefix_length(a, b):
+    """Number of leading tokens 'a' and 'b' have in common."""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class PrefixCache(LlamaRAMCache):
+    """
+    llama.cpp state cache that also counts how much of each prompt is reused.
+
+    llama.cpp only evaluates the part of a prompt that isn't already in its KV cache.
+    On its own it remembers just the last prompt, so the repeated samples of a question
+    reuse the context, but a criterion running in between (or the token scorer) throws
+    it away. This cache keeps the states after previous completions and llama.cpp
+    restores the one with the longest matching prefix before evaluating a prompt.
+
+    Saving the state isn't free: after every completion llama.cpp copies the KV cache
+    into the cache (see PROMPT_CACHE_BYTES). It would also copy the logits buffer
+    (n_ctx x n_vocab floats: 476 MiB and ~0.18 s per copy at a 3900 token context,
+    measured on a single Xeon core). That copy isn't counted against the capacity and
+    is only read back with logits_all, so otherwise it is left out of the state and
+    the model keeps its own buffer: llama.cpp evaluates at least the last prompt token
+    after a restore anyway. The time and size of the copies are part of 'stats' and are
+    recorded as the "state_save" phase.
+
+    Parameters:
+    model (llama_cpp.Llama): The model the cache is attached to.
+    capacity_bytes (int, optional): Memory for saved states, the least recently used go first.
+    """
+
+    def __init__(self, model, capacity_bytes=PROMPT_CACHE_BYTES):
+        super().__init__(capacity_bytes=capacity_bytes)
+        self.model = model
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        self.saves = 0
+        self.save_seconds = 0.0
+        self.saved_bytes = 0
+        self._stats_lock = threading.Lock()
+
+        # llama.cpp saves the state right before storing it in the cache, time the copy
+        save_state = model.save_state
+        load_state = model.load_state
+        keep_scores = model.context_params.logits_all
+
+        def timed_save_state():
+            start = time.perf_counter()
+            scores = model.scores
+            if not keep_scores:
+                # an empty view, save_state copies it instead of the whole buffer
+                model.scores = scores[:0]
+            try:
+                state = save_state()
+            finally:
+                model.scores = scores
+            seconds = time.perf_counter() - start
+            metrics.record("state_save", seconds)
+            with self._stats_lock:
+                self.saves += 1
+                self.save_seconds += seconds
+                self.saved_bytes += state.llama_state_size + state.scores.nbytes
+            return state
+
+        def restore_state(state):
+            scores = model.scores
+            load_state(state)
+            if not len(state.scores):
+                model.scores = scores
+
+        model.save_state = timed_save_state
+        model.load_state = restore_state
+
+    def __getitem__(self, key):
+        # llama.cpp looks up the prompt tokens once per completion, it continues from
+        # the evaluated tokens or the cached state, whichever shares the longer prefix
+        # (the last token is always evaluated to get fresh logits)
+        prompt = list(key)[:-1]
+        # only the first n_tokens of the buffer are evaluated, the rest are stale
+        evaluated = self.model.input_ids[: self.model.n_tokens].tolist()
+        reused = max(
+            [common_prefix_length(evaluated, prompt)]
+            + [common_prefix_length(cached, prompt) for cached in self.cache_state]
+        )
+        with self._stats_lock:
+            self.lookups += 1
+            self.hits += reused >= PREFIX_HIT_MIN_TOKENS
+            self.prompt_tokens += len(key)
+            self.reused_tokens += reused
+        return super().__getitem__(key)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "prompts": self.lookups,
+                "prefix_hits": self.hits,
+                "prefix_hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "prompt_tokens": self.prompt_tokens,
+                "reused_tokens": self.reused_tokens,
+                "reused_token_share": (
+                    self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+                ),
+                "cached_states": len(self.cache_state),
+                "cache_bytes": self.cache_size,
+                "state_saves": self.saves,
+                "state_save_seconds": round(self.save_seconds, 3),
+                "bytes_per_state": self.saved_bytes // self.saves if self.saves else 0,
+            }
@@ -0,0 +1,138 @@
+import itertools
+import threading
+import time
+from collections import deque
+
+# versions are unique across stores, so a page that switches to a new store (the next
+# run of a job) never mistakes its first version for one it has already shown
+_versions = itertools.count(1)
+
+
+class ProgressStore:
+    """
+    Thread-safe, in-memory record of the progress and results of an assessment.
+
+    The assessment thread(s) publish structured events, the dashboard callbacks
+    read the current status and result rows. Both are kept up to date as events
+    arrive, so reading them is O(1), and each has a version that only changes when
+    something new was published.
+
+    Event types:
+        - stage_started / stage_finished: a criterion (stage) starts or ends.
+        - iteration: sample k of N of a stage.
+        - result: a row of the results table.
+        - status: a free-form status message, e.g. the final letter.
+
+    Timings (see functions.metrics) are kept apart from the events, aggregated per
+    criterion and phase for the timing table. So are the raw samples of the model
+    ('samples'), for the assessment history.
+
+    Parameters:
+    max_events (int, optional): Number of most recent events kept in 'events'.
+    """
+
+    def __init__(self, max_events=1000):
+        self._lock = threading.Lock()
+        self._max_events = max_events
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.events = deque(maxlen=self._max_events)
+            self._active = {}  # stage -> latest message, in start order
+            self._status = None
+            self._rows = []
+            self.timing_records = []
+            self.samples = []
+            self._timings = {}  # (criterion, phase) -> [calls, seconds, tokens]
+            self.timings_version = next(_versions)
+            self.status_version = next(_versions)
+            self.results_version = next(_versions)
+
+    def _publish(self, event_type, stage=None, **data):
+        event = {"type": event_type, "stage": stage, "time": time.time(), **data}
+        self.events.append(event)
+        return event
+
+    def _set_active(self, stage, message):
+        self._active[stage] = message
+        self._status = None
+        self.status_version = next(_versions)
+
+    def stage_started(self, stage, message):
+        with self._lock:
+            self._publish("stage_started", stage, message=message)
+            self._set_active(stage, message)
+
+    def iteration(self, stage, k, n, message):
+        with self._lock:
+            self._publish("iteration", stage, k=k, n=n, message=message)
+            self._set_active(stage, f"{message} {k}/{n}")
+
+    def stage_finished(self, stage):
+        with self._lock:
+            self._publish("stage_finished", stage)
+            self._active.pop(stage, None)
+            self.status_version = next(_versions)
+
+    def result(self, desc, confidence, samples, output, criterion=None):
+        row = {
+            "criterion": criterion, "desc": desc, "confidence": confidence,
+            "samples": samples, "output": output,
+        }
+        with self._lock:
+            self._publish("result", **row)
+            self._rows.append(row)
+            self.results_version = next(_versions)
+
+    def sample(self, stage, iteration, response, answer):
+        """Keep the raw 'response' of sample 'iteration' of a stage and its parsed 'answer'."""
+        with self._lock:
+            self.samples.append({
+                "stage": stage, "iteration": iteration, "response": response, "answer": answer,
+            })
+
+    def timing(self, phase, criterion, seconds, tokens=None, iteration=None):
+        with self._lock:
+            self.timing_records.append({
+                "phase": phase, "criterion": criterion, "iteration": iteration,
+                "seconds": seconds, "tokens": tokens,
+            })
+            total = self._timings.setdefault((criterion, phase), [0, 0.0, 0])
+            total[0] += 1
+            total[1] += seconds
+            total[2] += tokens or 0
+            self.timings_version = next(_versions)
+
+    def get_timings(self):
+        """Return (version, rows) of the timing table, one row per criterion and phase."""
+        with self._lock:
+            rows = [
+                {
+                    "criterion": criterion,
+                    "phase": phase,
+                    "calls": calls,
+                    "seconds": round(seconds, 3),
+                    "tokens_per_second": round(tokens / seconds, 1) if tokens and seconds else "",
+                }
+                for (criterion, phase), (calls, seconds, tokens) in self._timings.items()
+            ]
+            return self.timings_version, rows
+
+    def set_status(self, status):
+        with self._lock:
+            self._publish("status", message=status)
+            self._status = status
+            self.status_version = next(_versions)
+
+    def get_status(self):
+        """Return (version, text), the text lists the running stages unless a status was set."""
+        with self._lock:
+            if self._status is not None:
+                return self.status_version, self._status
+            return self.status_version, "\n".join(self._active.values())
+
+    def get_results(self):
+        """Return (version, rows) of the results table."""
+        with self._lock:
+            return self.results_version, list(self._rows)
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from llama_index.response.schema import Response
+from llama_index.schema import QueryBundle
+
+from functions.output_schemas import current_schema
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "./cache/responses.sqlite")
+
+# entries kept on disk / in memory before the least recently used ones are evicted
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 100000))
+RESPONSE_CACHE_MEMORY_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MEMORY_ENTRIES", 2048))
+
+
+class ResponseCache:
+    """
+    Two-level cache of LLM responses: an in-memory LRU in front of a sqlite file.
+
+    Parameters:
+    path (str, optional): Location of the sqlite file.
+    max_entries (int, optional): Size cap of the on-disk store.
+    memory_entries (int, optional): Size of the in-memory LRU.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 memory_entries=RESPONSE_CACHE_MEMORY_ENTRIES):
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # the dashboard, the inference server and batch runs share the file: WAL lets
+        # them read while one writes, the timeout waits for the other writers
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self._db.commit()
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+            row = self._db.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+            self._remember(key, row[0])
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, last_used) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            self._puts += 1
+            # checking the size on every write would cost a table scan each time
+            if self._puts % 100 == 0:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        (count,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            logger.info("Response cache: evicted %d entries", count - self.max_entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the process-wide response cache, opening it on first use."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
+
+
+class CachedQueryEngine:
+    """
+    Wraps a retriever query engine and caches the generated responses.
+
+    A response is keyed on the document hash, the prompt, the ids of the retrieved
+    nodes, the model settings, the output schema and the sample index. The sample
+    index counts how often the same prompt over the same nodes was asked during this
+    run, so the k-th repeated sample of a question replays the k-th cached sample.
+
+    Parameters:
+    query_engine (RetrieverQueryEngine): The engine doing the actual work.
+    cache (ResponseCache): Where responses are stored.
+    document_hash (str): Hash of the assessed documents.
+    model_settings (dict): Model id, temperature and max_new_tokens.
+    refresh (bool, optional): Don't read from the cache (fresh samples are still stored).
+    """
+
+    def __init__(self, query_engine, cache, document_hash, model_settings, refresh=False):
+        self.query_engine = query_engine
+        self.cache = cache
+        self.document_hash = document_hash
+        self.model_settings = model_settings
+        self.refresh = refresh
+        self._sample_counts = {}
+        self._lock = threading.Lock()
+
+    def retrieve(self, query_bundle):
+        return self.query_engine.retrieve(query_bundle)
+
+    def _key(self, prompt, node_ids):
+        with self._lock:
+            counter_key = (prompt, tuple(node_ids))
+            sample_index = self._sample_counts.get(counter_key, 0)
+            self._sample_counts[counter_key] = sample_index + 1
+        schema = current_schema()
+        key = json.dumps(
+            [
+                self.document_hash,
+                prompt,
+                node_ids,
+                self.model_settings,
+                schema.name if schema is not None else None,
+                sample_index,
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def synthesize(self, query_bundle, nodes):
+        key = self._key(query_bundle.query_str, [node.node.node_id for node in nodes])
+        if not self.refresh:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return Response(response=cached, source_nodes=nodes)
+
+        response = self.query_engine.synthesize(query_bundle, nodes)
+        self.cache.put(key, str(response.response))
+        return response
+
+    def query(self, question):
+        query_bundle = QueryBundle(question)
+        return self.synthesize(query_bundle, self.retrieve(query_bundle))
@@ -0,0 +1,175 @@
+class Rule:
+    """
+    A declarative decision rule over the answers of the assessment criteria.
+
+    A rule evaluates to True, False or None (not known yet) for the answers found so
+    far, and can tell which criteria still have to be answered before its value is
+    known. Criteria that can no longer change the value are never listed, so they are
+    never asked.
+    """
+
+    # a guard has to hold before the rules after it in an AllOf are worth asking
+    guard = False
+
+    def value(self, answers):
+        raise NotImplementedError
+
+    def pending(self, answers):
+        """Criteria whose answers could still change the value, in the order to ask them."""
+        raise NotImplementedError
+
+    def criteria(self):
+        """Every criterion the rule refers to."""
+        raise NotImplementedError
+
+
+class Answer(Rule):
+    """True if 'criterion' was answered with 'expected', e.g. Answer("symptomatic", "Yes")."""
+
+    def __init__(self, criterion, expected):
+        self.criterion = criterion
+        self.expected = expected
+
+    def value(self, answers):
+        if self.criterion not in answers:
+            return None
+        return answers[self.criterion] == self.expected
+
+    def pending(self, answers):
+        return [] if self.criterion in answers else [self.criterion]
+
+    def criteria(self):
+        return {self.criterion}
+
+
+class Check(Answer):
+    """
+    A condition on an answer, e.g. Check("age", lambda age: age >= 40). A Check is a
+    guard: the rules after it in an AllOf are only asked once it holds.
+    """
+
+    guard = True
+
+    def __init__(self, criterion, predicate):
+        self.criterion = criterion
+        self.predicate = predicate
+
+    def value(self, answers):
+        if self.criterion not in answers:
+            return None
+        # an answer that couldn't be found doesn't satisfy any condition
+        answer = answers[self.criterion]
+        return answer is not None and bool(self.predicate(answer))
+
+
+class Not(Rule):
+    def __init__(self, rule):
+        self.rule = rule
+
+    def value(self, answers):
+        value = self.rule.value(answers)
+        return None if value is None else not value
+
+    def pending(self, answers):
+        return self.rule.pending(answers)
+
+    def criteria(self):
+        return self.rule.criteria()
+
+
+class AllOf(Rule):
+    def __init__(self, *rules):
+        self.rules = rules
+
+    def value(self, answers):
+        values = [rule.value(answers) for rule in self.rules]
+        if False in values:
+            return False
+        if None in values:
+            return None
+        return True
+
+    def pending(self, answers):
+        if self.value(answers) is not None:
+            return []
+        pending = []
+        for rule in self.rules:
+            value = rule.value(answers)
+            if value is None:
+                pending += rule.pending(answers)
+                if rule.guard:
+                    break
+        return pending
+
+    def criteria(self):
+        return set().union(*(rule.criteria() for rule in self.rules))
+
+
+class AnyOf(Rule):
+    def __init__(self, *rules):
+        self.rules = rules
+
+    def value(self, answers):
+        values = [rule.value(answers) for rule in self.rules]
+        if True in values:
+            return True
+        if None in values:
+            return None
+        return False
+
+    def pending(self, answers):
+        if self.value(answers) is not None:
+            return []
+        pending = []
+        for rule in self.rules:
+            pending += rule.pending(answers)
+        return pending
+
+    def criteria(self):
+        return set().union(*(rule.criteria() for rule in self.rules))
+
+
+class Decision:
+    """
+    An ordered list of (rule, verdict) pairs: the verdict of the first rule that holds
+    wins, 'default' if none does.
+
+    Parameters:
+    branches (list of tuple): (Rule, verdict) pairs, in order of precedence.
+    default: The verdict when no rule holds.
+    """
+
+    def __init__(self, branches, default):
+        self.branches = branches
+        self.default = default
+
+    def verdict(self, answers):
+        """The verdict, or None while it depends on unanswered criteria."""
+        for rule, verdict in self.branches:
+            value = rule.value(answers)
+            if value is None:
+                return None
+            if value:
+                return verdict
+        return self.default
+
+    def pending(self, answers, cost):
+        """
+        Criteria that could still change the verdict, in the order to ask them.
+
+        Criteria of an earlier branch come first, as they take precedence; within a
+        branch the cheapest criterion according to 'cost' (a name -> cost mapping) first.
+        """
+        pending = []
+        for rank, (rule, _) in enumerate(self.branches):
+            for position, criterion in enumerate(rule.pending(answers)):
+                pending.append(((rank, cost.get(criterion, 0), position), criterion))
+
+        ordered = []
+        for _, criterion in sorted(pending):
+            if criterion not in ordered:
+                ordered.append(criterion)
+        return ordered
+
+    def criteria(self):
+        return set().union(*(rule.criteria() for rule, _ in self.branches))
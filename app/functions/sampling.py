@@ -0,0 +1,113 @@
+import math
+
+from llama_index.schema import QueryBundle
+
+from functions.metrics import labels
+
+
+def iter_samples(query_engine, question, n_samples, shared_retrieval=True):
+    """
+    Ask the same question 'n_samples' times and yield each response text.
+
+    With 'shared_retrieval' the question is embedded and the relevant nodes are
+    retrieved only once, after which only the LLM generation is repeated.
+    Otherwise every sample runs a full query (retrieval + generation).
+
+    Parameters:
+    query_engine (RetrieverQueryEngine): The query engine over the documents.
+    question (str): The question to ask.
+    n_samples (int): Number of responses to generate.
+    shared_retrieval (bool, optional): Retrieve once and reuse the nodes. Defaults to True.
+
+    Yields:
+    str: The response text of each sample.
+    """
+    if not shared_retrieval:
+        for i in range(n_samples):
+            with labels(iteration=i + 1):
+                text = query_engine.query(question).response
+            yield text
+        return
+
+    query_bundle = QueryBundle(question)
+    nodes = query_engine.retrieve(query_bundle)
+    for i in range(n_samples):
+        with labels(iteration=i + 1):
+            text = query_engine.synthesize(query_bundle, nodes).response
+        yield text
+
+
+def majority_vote(yes_count, no_count):
+    """Decision rule of evaluate_success: 'Yes' wins on a strict majority, None without votes."""
+    if yes_count == 0 and no_count == 0:
+        return None
+    return yes_count > no_count
+
+
+def wilson_lower_bound(successes, n, z=1.96):
+    """Lower bound of the Wilson score interval for a proportion of 'successes' out of 'n'."""
+    if n == 0:
+        return 0.0
+    p = successes / n
+    denominator = 1 + z**2 / n
+    centre = p + z**2 / (2 * n)
+    margin = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2))
+    return (centre - margin) / denominator
+
+
+class AdaptiveVote:
+    """
+    Tally of yes/no samples that knows when more samples can no longer change the outcome.
+
+    Sampling can stop as soon as either
+        - the outcome at 'max_samples' is locked, i.e. it is the same whether all remaining
+          samples vote yes or all vote no, or
+        - the lower bound of the Wilson interval on the share of the winning answer reaches
+          'confidence_bound' (after at least 'min_samples' samples).
+
+    Parameters:
+    max_samples (int): Hard cap on the number of samples.
+    decide (callable, optional): Maps (yes_count, no_count) to True/False/None.
+                                 Defaults to majority_vote.
+    confidence_bound (float, optional): Stop once the winning share is at least this
+                                        sure. Disabled when None (default).
+    min_samples (int, optional): Samples required before the confidence bound applies.
+    """
+
+    def __init__(self, max_samples, decide=majority_vote, confidence_bound=None, min_samples=3):
+        self.max_samples = max_samples
+        self.decide = decide
+        self.confidence_bound = confidence_bound
+        self.min_samples = min_samples
+        self.yes_count = 0
+        self.no_count = 0
+        self.samples = 0
+
+    def add(self, vote):
+        """Record one sample, 'vote' is True (yes), False (no) or None (no answer found)."""
+        self.samples += 1
+        if vote is True:
+            self.yes_count += 1
+        elif vote is False:
+            self.no_count += 1
+
+    def is_decided(self):
+        if self.samples >= self.max_samples:
+            return True
+
+        remaining = self.max_samples - self.samples
+        outcome = self.decide(self.yes_count + remaining, self.no_count)
+        if outcome is not None and outcome == self.decide(
+            self.yes_count, self.no_count + remaining
+        ):
+            return True
+
+        if self.confidence_bound is not None and self.samples >= self.min_samples:
+            outcome = self.decide(self.yes_count, self.no_count)
+            if outcome is not None:
+                winning = self.yes_count if outcome else self.no_count
+                votes = self.yes_count + self.no_count
+                if wilson_lower_bound(winning, votes) >= self.confidence_bound:
+                    return True
+
+        return False
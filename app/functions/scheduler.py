@@ -0,0 +1,104 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from functions.cancellation import Cancelled
+
+
+def default_max_workers(model_contexts):
+    """
+    Size the worker pool by the number of model contexts that can generate side by side.
+
+    A criterion spends most of its time generating, and generations take turns on a
+    model context (see SerializedLlamaCPP). A second criterion per context only waits
+    for its turn and is asked before the verdict shows whether it is needed at all.
+    """
+    return max(1, model_contexts)
+
+
+class RuleScheduler:
+    """
+    Asks the criteria of a Decision lazily, on a bounded thread pool.
+
+    Only criteria that can still change the verdict are asked, cheapest first (see
+    Decision.pending), and as soon as the verdict is known 'cancelled' is set: pending
+    criteria are never started and running criteria are expected to check 'cancelled'
+    and return early.
+
+    Only one criterion at a time is needed for sure, the next ones in line are asked
+    speculatively. They take generation time from the needed one unless the model has
+    a context to spare, so no more criteria run at once than there are 'model_contexts'.
+
+    Every criterion is a function that receives the answers found so far (a dict keyed
+    by name) and returns its own answer.
+
+    Parameters:
+    max_workers (int): Size of the worker pool.
+    abort (CancelToken, optional): Cancels the whole run when set, run raises Cancelled.
+    model_contexts (int, optional): Model contexts that generate side by side, 1 for a
+                                    serialized model. Defaults to 'max_workers'.
+    """
+
+    def __init__(self, max_workers, abort=None, model_contexts=None):
+        self.max_workers = max_workers
+        self.abort = abort
+        # criteria running at the same time, one per idle model context at most
+        self.concurrency = max(1, min(max_workers, model_contexts or max_workers))
+        self.cancelled = threading.Event()
+        self._criteria = {}
+        self._cost = {}
+
+    def add(self, name, fn, cost=1):
+        """Register criterion 'name', 'cost' estimates what asking it costs (e.g. in LLM calls)."""
+        self._criteria[name] = fn
+        self._cost[name] = cost
+
+    def run(self, decision):
+        """
+        Ask criteria until the verdict of 'decision' is known.
+
+        Returns:
+        tuple: (verdict, answers), answers of the criteria that were asked and finished
+               before the verdict was known. Exceptions raised by a criterion cancel
+               the run and are re-raised, an aborted run raises Cancelled.
+        """
+        unknown = decision.criteria() - set(self._criteria)
+        if unknown:
+            raise ValueError(f"The decision refers to unknown criteria: {sorted(unknown)}")
+
+        answers = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                # criteria of an aborted run return early, their answers mean nothing
+                if self.abort is not None and self.abort.is_set():
+                    self.cancelled.set()
+                    raise Cancelled()
+
+                verdict = decision.verdict(answers)
+                if verdict is not None:
+                    self.cancelled.set()
+                    break
+
+                asked = set(running.values())
+                for name in decision.pending(answers, self._cost):
+                    # only hand work to the pool when a model context is free, so
+                    # that an early verdict really leaves the pending criteria unasked
+                    if len(running) >= self.concurrency:
+                        break
+                    if name not in asked:
+                        running[pool.submit(self._criteria[name], dict(answers))] = name
+
+                if not running:
+                    raise RuntimeError("The verdict is unknown but no criterion is left to ask.")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        answers[name] = future.result()
+                    except Exception:
+                        self.cancelled.set()
+                        raise
+
+        return verdict, answers
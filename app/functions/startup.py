@@ -0,0 +1,82 @@
+import importlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The ML stack, in import order. The web layer doesn't import any of it, so the
+# dashboard serves at once and the warm-up imports it in the background.
+HEAVY_MODULES = [
+    "llama_index",
+    "llama_cpp",
+    "functions.model_registry",
+    "functions.medical_assessment",
+]
+
+_lock = threading.Lock()
+_thread = None
+_ready = threading.Event()
+_state = {"stage": "not started", "error": None, "import_seconds": {}}
+
+
+def timed_import(name):
+    """Import module 'name' and return the seconds it took, 0 if it was already imported."""
+    start = time.perf_counter()
+    importlib.import_module(name)
+    return time.perf_counter() - start
+
+
+def _warm_up(load_models):
+    try:
+        for name in HEAVY_MODULES:
+            _state["stage"] = f"importing {name}"
+            _state["import_seconds"][name] = round(timed_import(name), 3)
+
+        # a broken guideline keeps the app from becoming ready
+        _state["stage"] = "loading guidelines"
+        from functions.guidelines import load_guidelines
+
+        load_guidelines()
+
+        if load_models:
+            _state["stage"] = "loading models"
+            from functions import model_registry
+
+            model_registry.warm_up()
+
+        _state["stage"] = "ready"
+        _ready.set()
+        logger.info("Warm-up finished, imports: %s", _state["import_seconds"])
+    except Exception as e:
+        logger.exception("Warm-up failed")
+        _state["stage"] = "failed"
+        _state["error"] = str(e)
+
+
+def start_warm_up(load_models=False):
+    """
+    Import the ML stack and validate the guidelines in a background thread, once per
+    process. With 'load_models' the LLM and the embedding model are loaded too.
+    """
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(
+                target=_warm_up, args=(load_models,), name="warm-up", daemon=True
+            )
+            _thread.start()
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def status():
+    """The warm-up stage, its error if it failed and the import time per module."""
+    return {
+        "ready": is_ready(),
+        "stage": _state["stage"],
+        "error": _state["error"],
+        "import_seconds": dict(_state["import_seconds"]),
+    }
@@ -0,0 +1,94 @@
+import threading
+
+import numpy as np
+from llama_index.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT
+from llama_index.schema import QueryBundle
+
+# first tokens of the answers that count as a yes or a no
+YES_VARIANTS = ["Yes", "yes", "YES", " Yes", " yes"]
+NO_VARIANTS = ["No", "no", "NO", " No", " no"]
+
+
+class TokenProbabilityScorer:
+    """
+    Scores yes/no questions with a single forward pass of the llama.cpp model.
+
+    Instead of sampling an answer several times, the retrieved context and the question
+    are put in the same prompt the query engine would use, the model evaluates it once,
+    and the probabilities of the "Yes" and "No" answer tokens are read from the logits
+    of the next token.
+
+    Parameters:
+    llm (LlamaCPP): The llama-index LlamaCPP wrapper, its llama.cpp model is used directly.
+    lock (threading.Lock, optional): Lock that serializes evaluations on the model.
+    """
+
+    def __init__(self, llm, lock=None):
+        self.llm = llm
+        self.model = llm._model
+        self.lock = lock or threading.Lock()
+        self.yes_ids = self._first_tokens(YES_VARIANTS)
+        self.no_ids = self._first_tokens(NO_VARIANTS)
+
+    def _first_tokens(self, variants):
+        ids = set()
+        for variant in variants:
+            tokens = self.model.tokenize(variant.encode("utf-8"), add_bos=False)
+            if tokens:
+                ids.add(tokens[0])
+        return sorted(ids)
+
+    def build_prompt(self, question, nodes):
+        """The prompt the default response synthesizer sends for 'question' over 'nodes'."""
+        context = "\n\n".join(node.node.get_content() for node in nodes)
+        prompt = DEFAULT_TEXT_QA_PROMPT.format(context_str=context, query_str=question)
+        return self.llm.completion_to_prompt(prompt)
+
+    def next_token_logits(self, prompt):
+        """Evaluate 'prompt' and return the logits of the token that would follow it."""
+        tokens = self.model.tokenize(prompt.encode("utf-8"))
+        with self.lock:
+            # keep the part of the KV cache that matches the new prompt, at least
+            # one token has to be evaluated to get fresh logits. Only the first n_tokens
+            # of the buffer are in the KV cache, the rest are left over from longer prompts.
+            previous = self.model.input_ids[: self.model.n_tokens].tolist()
+            common = 0
+            for old, new in zip(previous, tokens[:-1]):
+                if old != new:
+                    break
+                common += 1
+            self.model.n_tokens = common
+            self.model.eval(tokens[common:])
+            return np.array(self.model.scores[self.model.n_tokens - 1], dtype=np.float64)
+
+    def yes_probability(self, question, nodes):
+        """
+        Probability that the answer to 'question' starts with yes rather than no.
+
+        Returns:
+        float: P(yes) / (P(yes) + P(no)) of the next token.
+        """
+        logits = self.next_token_logits(self.build_prompt(question, nodes))
+        # log-sum-exp over the yes and no variants, relative to each other
+        shift = logits.max()
+        p_yes = np.exp(logits[self.yes_ids] - shift).sum()
+        p_no = np.exp(logits[self.no_ids] - shift).sum()
+        return float(p_yes / (p_yes + p_no))
+
+    def score(self, query_engine, question):
+        """Retrieve the nodes for 'question' and return its yes probability."""
+        nodes = query_engine.retrieve(QueryBundle(question))
+        return self.yes_probability(question, nodes)
+
+
+class ProbabilityVote:
+    """
+    A yes probability presented like an AdaptiveVote tally, so the results table and
+    the decision rules treat both confidence modes the same way.
+    """
+
+    def __init__(self, yes_probability):
+        self.yes_count = yes_probability
+        self.no_count = 1 - yes_probability
+        self.samples = 1
+        self.max_samples = 1
@@ -0,0 +1,66 @@
+import hashlib
+import os
+
+# uploads larger than this are rejected while they stream in
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 100 * 1024**2))
+
+# bytes read from the request and written to disk at a time
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+def list_files(data_dir):
+    """
+    Return the sorted paths of the documents directly inside 'data_dir'. Uploads that
+    are still streaming in (.part, see save_upload) and hidden files are left out.
+    """
+    return [
+        os.path.join(data_dir, name)
+        for name in sorted(os.listdir(data_dir))
+        if not name.startswith(".")
+        and not name.endswith(".part")
+        and os.path.isfile(os.path.join(data_dir, name))
+    ]
+
+
+def save_upload(stream, folder, filename, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Stream an upload to 'folder' chunk by chunk and hash it on the way.
+
+    The file is written under a temporary name and only renamed once it is complete,
+    so a failed or oversized upload never leaves a partial pdf behind. The hash is
+    computed like hashing.hash_files([path]), so the caches can use it directly.
+
+    Parameters:
+    stream (file-like): The request body.
+    folder (str): The job's upload area.
+    filename (str): Name of the uploaded file, only its basename is used.
+    max_bytes (int, optional): Size limit of the upload.
+
+    Returns:
+    tuple: (path of the saved file, size in bytes, hex sha256 digest).
+    """
+    filename = os.path.basename(filename)
+    file_path = os.path.join(folder, filename)
+    part_path = file_path + ".part"
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(part_path, "wb") as f:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_BYTES), b""):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(
+                        f"The file is larger than {max_bytes // 1024**2} MB, please upload a smaller pdf."
+                    )
+                digest.update(chunk)
+                f.write(chunk)
+        os.replace(part_path, file_path)
+    finally:
+        if os.path.exists(part_path):
+            os.unlink(part_path)
+    return file_path, size, digest.hexdigest()
@@ -0,0 +1,45 @@
+"""
+Shared inference server for the dashboard and batch workers.
+
+Loads the LLM and the embedding model once and serves them over a local socket, so
+several web workers and batch runs on the same machine share one copy of the model
+weights. Generations are serialized on the model, embedding requests of all clients
+are embedded together in batches. The dashboard's assessment jobs run here as well,
+so the web workers share their queue, progress and cancel tokens.
+
+Usage:
+    export INFERENCE_SERVER_AUTHKEY=<a long random secret>
+    python app/inference_server.py --address 127.0.0.1:8765
+    INFERENCE_SERVER_ADDRESS=127.0.0.1:8765 python app/main.py
+"""
+import argparse
+import logging
+import os
+import sys
+
+from functions import model_registry
+from functions.inference_service import InferenceServer, parse_address
+
+logger = logging.getLogger("inference_server")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--address", default=os.environ.get("INFERENCE_SERVER_ADDRESS") or "127.0.0.1:8765",
+        help='"host:port" or a unix socket path, defaults to INFERENCE_SERVER_ADDRESS',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    # refuses to start without INFERENCE_SERVER_AUTHKEY, before the models are loaded
+    server = InferenceServer(parse_address(args.address))
+    # this process runs the models itself, even when INFERENCE_SERVER_ADDRESS points at it
+    model_registry.INFERENCE_SERVER_ADDRESS = None
+    model_registry.warm_up()
+
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
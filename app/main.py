@@ -2,36 +2,41 @@
 import dash
 import os
 import sys
-import pandas as pd
+import time
 from dash.exceptions import PreventUpdate
-from dash import Dash, html, dcc, Output, Input, State, callback
-import dash_bootstrap_components as dbc
-import base64
-import dash_table
-import threading
+from dash import Dash, html, dcc, Output, Input, State, callback, no_update, ClientsideFunction, ctx
+from dash import dash_table
+from flask import request, jsonify, Response
 
 
 ## llama index functions
 import logging
 
-from llama_index import VectorStoreIndex, SimpleDirectoryReader, ServiceContext
-from llama_index.llms import LlamaCPP
-from llama_index.llms.llama_utils import messages_to_prompt, completion_to_prompt
-from langchain_community.embeddings.huggingface import HuggingFaceEmbeddings
-from llama_index import ServiceContext
-from llama_index.embeddings import LangchainEmbedding
-
 ## other custom functions
+# Only light modules are imported here, so the server starts serving at once. The ML
+# stack (llama-index, llama.cpp, the embedding model) is imported by the background
+# warm-up (see functions.startup) or, at the latest, by the first job.
 from functions.styling_functions import get_button_style
-from functions.medical_assessment import run_assessment
+from functions.jobs import JobManager, RemoteJobManager
+from functions.uploads import save_upload, list_files, UploadTooLarge
+from functions.history import get_history
+from functions import startup
+
+# Configure logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 
-# Global variable, this is what we will use to answer all our questions.
-global query_engine
-query_engine = None
+# assessments per page of the history table
+HISTORY_PAGE_SIZE = 20
 
-# results will be written to
-temp_csv = "temp_results.csv"
+# Every browser session works on its own job (upload area, index and results),
+# jobs are queued against the shared models, see MAX_CONCURRENT_JOBS. With a shared
+# inference server the jobs run there, so any web worker can serve any session.
+INFERENCE_SERVER_ADDRESS = os.environ.get("INFERENCE_SERVER_ADDRESS") or None
+if INFERENCE_SERVER_ADDRESS:
+    jobs = RemoteJobManager(INFERENCE_SERVER_ADDRESS)
+else:
+    jobs = JobManager()
 
 
 # Create a Dash application
@@ -41,6 +46,16 @@ app.layout = html.Div(
     [
         # Store component to keep track of the model state
         dcc.Store(id="model-ready", storage_type="memory"),
+        # the job of this browser session
+        dcc.Store(id="job-id", storage_type="session"),
+        # versions of the status and results last pushed to the page
+        dcc.Store(id="status-version", storage_type="memory"),
+        dcc.Store(id="results-version", storage_type="memory"),
+        dcc.Store(id="timings-version", storage_type="memory"),
+        # run and state of the session's job, e.g. "2:done"
+        dcc.Store(id="job-state", storage_type="memory"),
+        # reply of the /upload endpoint for the last selected file
+        dcc.Store(id="upload-result", storage_type="memory"),
         # first part of the page:
 
         html.Div(
@@ -53,16 +68,26 @@ app.layout = html.Div(
                 }),
                 html.P(
                     "The first step is to select your pdf and we will assess the recommended procedure. "
-                    "A .pdf file needs to be present before loading your model.",
+                    "A .pdf file needs to be present before loading your model. "
+                    "Further documents of the same patient (lab results, prior reports) can be added "
+                    "later, a file with the same name replaces the earlier upload.",
                     style={
                         "textAlign": "center",
                         "fontFamily": "'Segoe UI', sans-serif",
                     },
                 ),
-                dcc.Upload(
-                    id="upload-file",
-                    children=html.Div(["Drag and Drop or ", html.A("Select Files")]),
+                # The file is posted to /upload by assets/upload.js and streamed to disk,
+                # the callbacks only see the reply (job id, size and hash).
+                html.Div(
+                    [
+                        "Drag and Drop or ",
+                        html.A("Select Files"),
+                    ],
+                    # Dash has no file input, assets/upload.js opens the file dialog
+                    # on a click and takes dropped files
+                    id="upload-drop-zone",
                     style={
+                        "display": "block",
                         "width": "100%",
                         "height": "60px",
                         "lineHeight": "60px",
@@ -71,11 +96,12 @@ app.layout = html.Div(
                         "borderRadius": "5px",
                         "textAlign": "center",
                         "margin": "10px",
+                        "cursor": "pointer",
                     },
-                    # Allow multiple files to be uploaded
-                    multiple=False,
                 ),
+                html.Button(id="upload-button", n_clicks=0, style={"display": "none"}),
                 html.Div(id="output-upload"),
+                html.Button("New patient", id="new-packet-button", n_clicks=0),
             ],
             style={"width": "80%", "margin": "auto", "padding": "20px"},
         ),  # Container styling for the first part of the page
@@ -98,13 +124,39 @@ app.layout = html.Div(
                        (See terminal for progress in this case.)"""),
                        
                 html.P("""Also note that the models run on CPU only due to time constraints for this exercise. """),
+                # How the confidence of the yes/no criteria is measured
+                dcc.RadioItems(
+                    id="confidence-mode",
+                    options=[
+                        {"label": " Majority vote over repeated samples", "value": "vote"},
+                        {"label": " Yes/No token probability (single pass)", "value": "logprob"},
+                    ],
+                    value="vote",
+                ),
+                # Ask the yes/no criteria one by one, or all at once as a JSON object
+                dcc.RadioItems(
+                    id="assessment-mode",
+                    options=[
+                        {"label": " One question per criterion", "value": "per_criterion"},
+                        {"label": " All criteria in one answer (majority vote only)", "value": "one_shot"},
+                    ],
+                    value="per_criterion",
+                ),
+                # Answers are cached per document, tick this to sample the model again
+                dcc.Checklist(
+                    id="fresh-samples",
+                    options=[{"label": " Fresh samples (ignore cached answers)", "value": "fresh"}],
+                    value=[],
+                ),
                 html.Button(
                     "Load Model",
                     id="load-model-button",
                     n_clicks=0,
                     style=get_button_style("grey"),
                 ),
+                html.Button("Cancel", id="cancel-button", n_clicks=0),
                 html.Div(id="button-output"),
+                html.Div(id="cancel-output"),
                 # Interval component for periodic checks
                 dcc.Interval(
                     id="interval-component",
@@ -134,10 +186,45 @@ app.layout = html.Div(
                     columns=[
                         {"name": "Description", "id": "desc"},
                         {"name": "Confidence", "id": "confidence"},
+                        {"name": "Samples", "id": "samples"},
                         {"name": "Output", "id": "output"},
                     ],
                     data=[],
                 ),
+                # Where the time of the assessment went, per criterion and phase
+                html.H3("Timing breakdown", style={"color": "#005073"}),
+                dash_table.DataTable(
+                    id="timing-table",
+                    columns=[
+                        {"name": "Criterion", "id": "criterion"},
+                        {"name": "Phase", "id": "phase"},
+                        {"name": "Calls", "id": "calls"},
+                        {"name": "Seconds", "id": "seconds"},
+                        {"name": "Tokens/s", "id": "tokens_per_second"},
+                    ],
+                    data=[],
+                    sort_action="native",
+                ),
+                # Earlier assessments, read from the history a page at a time
+                html.H3("Assessment history", style={"color": "#005073"}),
+                dcc.Input(id="history-cpt-code", type="number", placeholder="CPT code", debounce=True),
+                dcc.Input(id="history-document", type="text", placeholder="Document hash", debounce=True),
+                dash_table.DataTable(
+                    id="history-table",
+                    columns=[
+                        {"name": "Started", "id": "started"},
+                        {"name": "Documents", "id": "documents"},
+                        {"name": "CPT code", "id": "cpt_code"},
+                        {"name": "Recommendation", "id": "recommendation"},
+                        {"name": "Mode", "id": "mode"},
+                        {"name": "State", "id": "state"},
+                        {"name": "Seconds", "id": "seconds"},
+                    ],
+                    data=[],
+                    page_action="custom",
+                    page_current=0,
+                    page_size=HISTORY_PAGE_SIZE,
+                ),
             ],
             style={"width": "80%", "margin": "auto"},
         ), 
@@ -150,35 +237,101 @@ app.layout = html.Div(
 
 
 ##### now define the callbacks #####
+@app.server.route("/upload", methods=["POST"])
+def upload_file():
+    """
+    Receive a pdf as the raw request body and stream it into a job's upload area.
+    The filename and the session's job are passed as query parameters.
+    """
+    filename = os.path.basename(request.args.get("filename", ""))
+    # Check if the file is a PDF
+    if not filename.lower().endswith(".pdf"):
+        return jsonify(error="File is not a PDF. Please upload a PDF file."), 400
+
+    # Documents are added to the session's job, the patient's packet
+    job_id = request.args.get("job_id")
+    job = jobs.get(job_id) if job_id else None
+    if job is None:
+        job = jobs.create_job()
+    elif jobs.cancel(job.id):
+        # the running assessment is about documents that are being replaced
+        logging.info("Job %s: assessment cancelled by a new upload", job.id)
+
+    try:
+        file_path, size, content_hash = save_upload(request.stream, job.data_dir, filename)
+    except UploadTooLarge as e:
+        return jsonify(error=str(e)), 413
+
+    # The job's files form the patient's packet, the index is updated with just the
+    # new or replaced documents on the next assessment
+    jobs.add_document(job.id, file_path, content_hash)
+    logging.info("Job %s: received %s (%d bytes, sha256 %s)", job.id, filename, size, content_hash[:12])
+
+    documents = [os.path.basename(path) for path in list_files(job.data_dir)]
+    return jsonify(
+        job_id=job.id, filename=filename, size=size, content_hash=content_hash, documents=documents
+    )
+
+
+@app.server.route("/metrics")
+def metrics_endpoint():
+    """Time, calls and tokens per phase and criterion since the server started, as plain text."""
+    if isinstance(jobs, RemoteJobManager):
+        # the assessments run in the inference server
+        return Response(jobs.client.call("metrics"), mimetype="text/plain")
+
+    from functions import metrics
+
+    return Response(metrics.registry.render(), mimetype="text/plain")
+
+
+@app.server.route("/healthz")
+def healthz():
+    """Liveness: the web server answers, whether or not the models are ready."""
+    return jsonify(status="ok")
+
+
+@app.server.route("/readyz")
+def readyz():
+    """Readiness: the ML stack is imported and the guidelines are valid, 503 until then."""
+    # servers that don't run this file as a script start the warm-up on the first probe
+    startup.start_warm_up()
+    status = startup.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+# Selecting or dropping a file clicks the hidden upload button (see assets/upload.js),
+# the browser then posts the file to /upload and stores the reply.
+app.clientside_callback(
+    ClientsideFunction(namespace="uploads", function_name="upload_file"),
+    Output("upload-result", "data"),
+    Input("upload-button", "n_clicks"),
+    State("job-id", "data"),
+    prevent_initial_call=True,
+)
+
+
 @app.callback(
     Output("output-upload", "children"),
-    Input("upload-file", "filename"),
-    Input("upload-file", "contents"),
+    Output("job-id", "data"),
+    Input("upload-result", "data"),
+    Input("new-packet-button", "n_clicks"),
+    prevent_initial_call=True,
 )
-def update_output(uploaded_filename, uploaded_file_contents):
+def update_output(upload_result, new_packet_clicks):
     """ define the dropzone callback function"""
-    if uploaded_filename is None or uploaded_file_contents is None:
-        raise PreventUpdate
-
-    # Check if the file is a PDF
-    if not uploaded_filename.lower().endswith(".pdf"):
-        return "File is not a PDF. Please upload a PDF file."
+    if ctx.triggered_id == "new-packet-button":
+        # the next upload starts a new job, with an empty packet
+        return "", None
 
-    # Clear existing files in ./app/data
-    folder = "./app/data"
-    for file in os.listdir(folder):
-        file_path = os.path.join(folder, file)
-        if os.path.isfile(file_path):
-            os.unlink(file_path)
+    if not upload_result:
+        raise PreventUpdate
 
-    # Decode and save the uploaded PDF file
-    content_type, content_string = uploaded_file_contents.split(",")
-    decoded = base64.b64decode(content_string)
-    file_path = os.path.join(folder, uploaded_filename)
-    with open(file_path, "wb") as f:
-        f.write(decoded)
+    if "error" in upload_result:
+        return upload_result["error"], no_update
 
-    return "Upload completed!"
+    documents = ", ".join(upload_result["documents"])
+    return f"Upload completed! Documents: {documents}", upload_result["job_id"]
 
 
 @app.callback(
@@ -187,59 +340,30 @@ def update_output(uploaded_filename, uploaded_file_contents):
     Output("load-model-button", "style"),
     Output("button-output", "children"),
     Input("load-model-button", "n_clicks"),
+    State("job-id", "data"),
+    State("fresh-samples", "value"),
+    State("confidence-mode", "value"),
+    State("assessment-mode", "value"),
     prevent_initial_call=True,
 )
-def load_model(n_clicks):
+def load_model(n_clicks, job_id, fresh_samples, confidence_mode, assessment_mode):
     """ 
-    When the load-model button is pressed we remove any previous data from the table and start
-    the new model.
+    When the load-model button is pressed we queue the session's job, the previous
+    results of the job are removed and the worker loads the model and the index.
+    A run of the job that is still going is cancelled and replaced by the new one.
     """
-    global query_engine
     if n_clicks > 0:
-        # Check if temp_results.csv exists, and delete it if it does
-        if os.path.exists(temp_csv):
-            os.remove(temp_csv)
+        job = jobs.get(job_id) if job_id else None
+        if job is None:
+            return False, "Load Model", get_button_style("red"), "Please upload a pdf first."
 
         try:
-            # Configure logging
-            logging.basicConfig(stream=sys.stdout, level=logging.INFO)
-            logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
-
-            # Load documents
-            documents = SimpleDirectoryReader("./app/data/").load_data()
-
-            # Initialize the LlamaCPP model
-            llm = LlamaCPP(
-                model_url="https://huggingface.co/TheBloke/Mistral-7B-Instruct-v0.1-GGUF/resolve/main/mistral-7b-instruct-v0.1.Q5_K_M.gguf",
-                model_path=None,
-                temperature=0.1,
-                max_new_tokens=256,
-                context_window=3900,
-                generate_kwargs={},
-                model_kwargs={"n_gpu_layers": -1},
-                messages_to_prompt=messages_to_prompt,
-                completion_to_prompt=completion_to_prompt,
-                verbose=True,
-            )
-
-            # Initialize the embedding model
-            embed_model = LangchainEmbedding(
-                HuggingFaceEmbeddings(model_name="thenlper/gte-large")
-            )
-
-            # Set up the service context
-            service_context = ServiceContext.from_defaults(
-                chunk_size=1024, llm=llm, embed_model=embed_model
-            )
-
-            # Create an index from documents
-            index = VectorStoreIndex.from_documents(
-                documents, service_context=service_context
+            jobs.submit(
+                job.id,
+                refresh_responses="fresh" in (fresh_samples or []),
+                confidence_mode=confidence_mode,
+                mode=assessment_mode,
             )
-
-            # Create a query engine
-            query_engine = index.as_query_engine()
-
             return True, "Model Loaded", get_button_style("green"), ""
         except Exception as e:
             return False, "Loading Failed", get_button_style("red"), str(e)
@@ -247,43 +371,152 @@ def load_model(n_clicks):
     raise PreventUpdate
 
 
+@app.callback(
+    Output("cancel-output", "children"),
+    Input("cancel-button", "n_clicks"),
+    State("job-id", "data"),
+    prevent_initial_call=True,
+)
+def cancel_assessment(n_clicks, job_id):
+    """Stop the session's assessment, the model is free again after the current token."""
+    if job_id and jobs.cancel(job_id):
+        return "Cancelling the assessment..."
+    return "No assessment is running."
+
+
 # Callback to update the interval component
 @app.callback(
     Output("interval-component", "disabled"),
     Input("model-ready", "data"),
 )
 def update_interval(model_ready):
-    if model_ready:
-        thread = threading.Thread(target=run_assessment, args=(query_engine, temp_csv))
-        thread.daemon = True
-        thread.start()
     return not model_ready
 
 
-# Callback to update the table
+# Callback to update the table, only pushes rows when new results arrived
+@app.callback(
+    Output("results-table", "data"),
+    Output("results-version", "data"),
+    Input("interval-component", "n_intervals"),
+    State("results-version", "data"),
+    State("job-id", "data"),
+)
+def update_table(n_intervals, seen_version, job_id):
+    job = jobs.get(job_id) if job_id else None
+    if job is None:
+        raise PreventUpdate
+    version, rows = job.progress.get_results()
+    if version == seen_version:
+        return no_update, no_update
+    return rows, version
+
+
+# Callback to update the timing breakdown, only pushes rows when new timings arrived
 @app.callback(
-    Output("results-table", "data"), Input("interval-component", "n_intervals")
+    Output("timing-table", "data"),
+    Output("timings-version", "data"),
+    Input("interval-component", "n_intervals"),
+    State("timings-version", "data"),
+    State("job-id", "data"),
 )
-def update_table(n_intervals):
-    if os.path.exists(temp_csv):
-        df = pd.read_csv(temp_csv)
-        return df.to_dict("records")
-    return []
+def update_timings(n_intervals, seen_version, job_id):
+    job = jobs.get(job_id) if job_id else None
+    if job is None:
+        raise PreventUpdate
+    version, rows = job.progress.get_timings()
+    if version == seen_version:
+        return no_update, no_update
+    return rows, version
 
 
-# Callback to update the status display
+# Callback to track the state of the session's job. The history row of a run is
+# written before the run is marked done, failed or cancelled, so a change of state
+# is when the history table has something new to show.
 @app.callback(
-    Output("status-display", "children"), Input("interval-component", "n_intervals")
+    Output("job-state", "data"),
+    Input("interval-component", "n_intervals"),
+    State("job-state", "data"),
+    State("job-id", "data"),
 )
-def update_status(n_intervals):
-    if os.path.exists("status.txt"):
-        with open("status.txt", "r") as file:
-            status = file.read()
-            # Use html.Pre to preserve the formatting with new line characters
-            return html.Pre(status, style={"white-space": "pre-wrap"})
-    return "No status update"
+def update_job_state(n_intervals, seen_state, job_id):
+    job = jobs.get(job_id) if job_id else None
+    if job is None:
+        raise PreventUpdate
+    # the run number tells two finished runs of the same job apart
+    state = f"{job.run_id}:{job.state}"
+    if state == seen_state:
+        raise PreventUpdate
+    return state
+
+
+# Callback to page through the assessment history, a page is one indexed query.
+# It refreshes when the job changes state rather than on every interval tick.
+@app.callback(
+    Output("history-table", "data"),
+    Output("history-table", "page_count"),
+    Input("history-table", "page_current"),
+    Input("history-cpt-code", "value"),
+    Input("history-document", "value"),
+    Input("job-state", "data"),
+)
+def update_history(page_current, cpt_code, document_hash, job_state):
+    history = get_history()
+    filters = {"cpt_code": cpt_code, "document_hash": (document_hash or "").strip().lower()}
+    count = history.count(**filters)
+    rows = history.page(offset=(page_current or 0) * HISTORY_PAGE_SIZE, limit=HISTORY_PAGE_SIZE, **filters)
+    data = [
+        {
+            "started": time.strftime("%Y-%m-%d %H:%M", time.localtime(row["started_at"])),
+            "documents": row["documents"],
+            "cpt_code": row["cpt_code"],
+            "recommendation": row["recommendation"],
+            "mode": row["mode"],
+            "state": row["state"],
+            "seconds": round(row["finished_at"] - row["started_at"], 1),
+        }
+        for row in rows
+    ]
+    return data, max(1, -(-count // HISTORY_PAGE_SIZE))
+
+
+# Callback to update the status display, only pushes the status when it changed
+@app.callback(
+    Output("status-display", "children"),
+    Output("status-version", "data"),
+    Input("interval-component", "n_intervals"),
+    State("status-version", "data"),
+    State("job-id", "data"),
+)
+def update_status(n_intervals, seen_version, job_id):
+    job = jobs.get(job_id) if job_id else None
+    if job is None:
+        raise PreventUpdate
+
+    version, status = job.progress.get_status()
+    if job.state == "queued":
+        stats = jobs.stats()
+        # the store's version, marked as the queue message: the first status of the
+        # started run is always pushed, even if the store hasn't changed since
+        return html.Pre(
+            f"Waiting for a free slot... position {jobs.queue_position(job)} of {stats['queued']} in the queue, "
+            f"waiting for {job.wait_time:.0f}s (average wait {stats['average_wait']:.0f}s, "
+            f"{stats['running']}/{stats['max_concurrent']} assessments running).",
+            style={"white-space": "pre-wrap"},
+        ), f"queued:{version}"
+
+    if version == seen_version:
+        return no_update, no_update
+    if not status:
+        return "No status update", version
+    # Use html.Pre to preserve the formatting with new line characters
+    return html.Pre(status, style={"white-space": "pre-wrap"}), version
 
 
 # Run the app
 if __name__ == "__main__":
+    # Import the ML stack in the background while the server already serves, optionally
+    # loading the models too so the first assessment doesn't wait for them.
+    # With debug=True the reloader re-runs this script, only warm up in the serving process.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        startup.start_warm_up(load_models=os.environ.get("EAGER_MODEL_LOAD") == "1")
     app.run_server(debug=True, host="0.0.0.0", port=80)
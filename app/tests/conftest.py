@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app imports its modules as "functions.x", relative to app/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
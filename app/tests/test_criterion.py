@@ -0,0 +1,15 @@
+import types
+
+from functions.guidelines import Criterion
+
+
+def vote(yes_count, no_count, samples):
+    return types.SimpleNamespace(yes_count=yes_count, no_count=no_count, samples=samples)
+
+
+def test_the_confidence_is_the_share_the_vote_was_decided_on():
+    criterion = Criterion("relatives", "?", "Relatives", "...", yes_share=0.5)
+    # 2 of 6 samples abstained, 3 of the 4 answers were "No"
+    assert criterion.summarize(vote(1, 3, 6)) == ("No", "75.0 % sure")
+    assert criterion.summarize(vote(3, 1, 9)) == ("Yes", "75.0 % sure")
+    assert criterion.summarize(vote(0, 0, 3)) == (None, "Unsure.")
@@ -0,0 +1,27 @@
+import os
+
+from functions.extraction import extract_cpt_code, read_pdf_text
+
+RECORD_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "medical-record-3.pdf")
+
+
+def test_requested_procedure_code_is_found():
+    assert extract_cpt_code("Requested procedure: CPT code 45378\n") == 45378
+    assert extract_cpt_code("Referral for colonoscopy (CPT 45378), phone 217-555-0134\n") == 45378
+
+
+def test_codes_without_a_request_are_ignored():
+    assert extract_cpt_code("CPT code 45378\nSpringfield, IL 62704\n") is None
+
+
+def test_past_procedures_are_not_taken_for_the_request():
+    text = read_pdf_text([RECORD_PATH])
+    # without the cholecystectomy line the colonoscopy of 2020 is the only "CPT Code"
+    # left, but the record requests 43235 and 43239: the LLM has to decide
+    text = "\n".join(line for line in text.splitlines() if "47562" not in line)
+    assert "Colonoscopy on 07/22/2020 (CPT Code 45378" in text
+    assert extract_cpt_code(text) is None
+
+
+def test_dated_request_lines_are_skipped():
+    assert extract_cpt_code("Colonoscopy ordered on 07/22/2020 (CPT Code 45378)\n") is None
@@ -0,0 +1,21 @@
+import io
+
+from functions.hashing import hash_files
+from functions.uploads import save_upload
+
+
+def test_the_hash_only_depends_on_the_bytes(tmp_path):
+    (tmp_path / "a.pdf").write_bytes(b"letter")
+    (tmp_path / "renamed.pdf").write_bytes(b"letter")
+    (tmp_path / "labs.pdf").write_bytes(b"labs")
+
+    assert hash_files([tmp_path / "a.pdf"]) == hash_files([tmp_path / "renamed.pdf"])
+    assert hash_files([tmp_path / "a.pdf", tmp_path / "labs.pdf"]) == hash_files(
+        [tmp_path / "labs.pdf", tmp_path / "renamed.pdf"]
+    )
+
+
+def test_uploads_are_hashed_like_the_saved_file(tmp_path):
+    path, size, content_hash = save_upload(io.BytesIO(b"letter"), str(tmp_path), "copy.pdf")
+    assert size == 6
+    assert content_hash == hash_files([path])
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+from llama_index import ServiceContext
+
+from functions.benchmark_backends import StubEmbedding, StubLLM, referral_lines, write_pdf
+from functions.guidelines import load_guidelines
+from functions.index_cache import load_or_build_index
+from functions.medical_assessment import run_assessment
+from functions.output_schemas import DATE
+from functions.progress import ProgressStore
+
+
+@pytest.mark.parametrize("answer", ["Unknown", "19/39/2999", "02/31/1990", "13/01/1990", ""])
+def test_date_parse_rejects_invalid_dates(answer):
+    assert DATE.parse(answer) is None
+
+
+def test_date_parse_accepts_valid_dates():
+    assert DATE.parse("03/14/1958") == "03/14/1958"
+    assert DATE.parse("The patient was born on 03/14/1958.") == "03/14/1958"
+
+
+def test_unknown_date_of_birth_does_not_fail_the_assessment(tmp_path):
+    load_guidelines()
+    pdf_path = os.path.join(tmp_path, "referral.pdf")
+    write_pdf(pdf_path, referral_lines(45378, "03/14/1958", ["No further history."]))
+    service_context = ServiceContext.from_defaults(
+        chunk_size=1024,
+        llm=StubLLM(date_of_birth="Unknown", answers={"colonoscopy": 0.0}),
+        embed_model=StubEmbedding(),
+    )
+    index = load_or_build_index(
+        [pdf_path], service_context, 1024, "stub", cache_dir=str(tmp_path / "index")
+    )
+
+    # without the document text the date of birth has to come from the LLM
+    results = run_assessment(index.as_query_engine(), ProgressStore(), document_text=None)
+
+    assert results["age"] == "Unknown"
+    # "older than 45 without a colonoscopy" can't hold for an unknown age
+    assert results["recommendation"] == "not_required"
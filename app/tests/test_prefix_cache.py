@@ -0,0 +1,43 @@
+import types
+
+import numpy as np
+from llama_cpp import LlamaState
+
+from functions.prefix_cache import PrefixCache
+
+
+class FakeLlama:
+    # the part of llama_cpp.Llama the cache touches, with the same copies
+    def __init__(self, logits_all):
+        self.context_params = types.SimpleNamespace(logits_all=logits_all)
+        self.scores = np.zeros((8, 4), dtype=np.single)
+        self.input_ids = np.zeros(8, dtype=np.intc)
+        self.n_tokens = 0
+
+    def save_state(self):
+        return LlamaState(
+            scores=self.scores.copy(), input_ids=self.input_ids.copy(), n_tokens=self.n_tokens,
+            llama_state=b"kv", llama_state_size=2,
+        )
+
+    def load_state(self, state):
+        self.scores = state.scores.copy()
+        self.input_ids = state.input_ids.copy()
+        self.n_tokens = state.n_tokens
+
+
+def test_the_logits_are_only_saved_with_logits_all():
+    model = FakeLlama(logits_all=False)
+    cache = PrefixCache(model, capacity_bytes=1 << 20)
+    buffer = model.scores
+
+    state = model.save_state()
+    assert state.scores.size == 0
+    model.load_state(state)
+    # the model keeps its own buffer, the evaluation after a restore writes into it
+    assert model.scores is buffer
+    assert cache.stats()["bytes_per_state"] == 2
+
+    model = FakeLlama(logits_all=True)
+    PrefixCache(model, capacity_bytes=1 << 20)
+    assert model.save_state().scores.shape == (8, 4)
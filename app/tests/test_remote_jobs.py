@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+
+from functions.inference_service import InferenceServer
+from functions.jobs import JobManager, RemoteJobManager
+
+AUTHKEY = b"test-secret"
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def remote_jobs(tmp_path):
+    release = threading.Event()
+
+    def run_job(job, cancelled, progress, options):
+        progress.result("Code", "-", "-", options["code"], criterion="code")
+        while not release.is_set():
+            cancelled.check()
+            time.sleep(0.01)
+        progress.set_status(f"Documents: {sorted(job.document_hashes.values())}")
+
+    address = str(tmp_path / "server.sock")
+    server = InferenceServer(
+        address, authkey=AUTHKEY, llm=object(), embed_model=object(),
+        jobs=JobManager(run_job, jobs_dir=str(tmp_path / "jobs")),
+    )
+    server.start()
+    # two web workers, each with its own connection to the server
+    return [RemoteJobManager(address, authkey=AUTHKEY) for _ in range(2)], release
+
+
+def test_jobs_are_shared_by_the_web_workers(remote_jobs):
+    (first, second), release = remote_jobs
+    job = first.create_job()
+    first.add_document(job.id, job.data_dir + "/letter.pdf", "abc")
+    second.submit(job.id, code=45378)
+
+    # the other worker sees the run, its progress and finally its result
+    wait_for(lambda: first.get(job.id).state == "running")
+    assert first.get(job.id).progress.get_results()[1][0]["output"] == 45378
+    release.set()
+    wait_for(lambda: second.get(job.id).state == "done")
+    assert first.get(job.id).progress.get_status()[1] == "Documents: ['abc']"
+
+
+def test_a_worker_cancels_the_run_of_another(remote_jobs):
+    (first, second), _ = remote_jobs
+    job = first.create_job()
+    first.submit(job.id, code=45378)
+    wait_for(lambda: second.get(job.id).state == "running")
+
+    assert second.cancel(job.id)
+    wait_for(lambda: first.get(job.id).state == "cancelled")
+    assert first.get("unknown") is None
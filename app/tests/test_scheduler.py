@@ -0,0 +1,28 @@
+import argparse
+
+import pytest
+
+import benchmark
+
+
+def llm_calls(scenario, tmp_path, max_workers, model_contexts=1):
+    args = argparse.Namespace(
+        filler_pages=0, prompt_latency=0.0, token_latency=0.001, embed_latency=0.0, seed=0,
+        confidence_bound=None, max_workers=max_workers, model_contexts=model_contexts,
+    )
+    result = benchmark.run_scenario(
+        scenario, benchmark.SCENARIOS[scenario], "per_criterion", args, str(tmp_path)
+    )
+    return result["llm_calls"]
+
+
+@pytest.mark.parametrize("scenario", ["non_colonoscopy", "prior_success"])
+def test_more_workers_do_not_speculate_on_a_serialized_model(scenario, tmp_path):
+    # the verdict is known early, nothing after the deciding criterion is asked
+    assert llm_calls(scenario, tmp_path, max_workers=4) == llm_calls(scenario, tmp_path, max_workers=1)
+
+
+def test_idle_model_contexts_are_used_to_speculate(tmp_path):
+    assert llm_calls("prior_success", tmp_path, max_workers=2, model_contexts=2) > llm_calls(
+        "prior_success", tmp_path, max_workers=1
+    )